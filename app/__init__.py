@@ -42,6 +42,7 @@ def create_app(config_name="default"):
             migrate.init_app(app, db, render_as_batch=True)
         else:
             migrate.init_app(app, db)
+        dialect = db.engine.dialect.name
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
@@ -51,9 +52,32 @@ def create_app(config_name="default"):
         if app.config["ELASTICSEARCH_URL"]
         else None
     )
+    from app.search_backends import create_backend
+
+    app.search_backend = create_backend(app.config["SEARCH_BACKEND"], dialect)
     app.redis = Redis.from_url(app.config["REDIS_URL"])
     app.task_queue = rq.Queue("alpine-tasks", connection=app.redis)
 
+    from app.activity import LastSeenBuffer
+
+    app.last_seen_buffer = LastSeenBuffer(
+        app.config["LAST_SEEN_GRANULARITY"], app.config["LAST_SEEN_FLUSH_INTERVAL"]
+    )
+    if not app.testing:
+        app.last_seen_buffer.start(app)
+
+    from app.identity import IdentityCache
+
+    app.identity_cache = IdentityCache(
+        app.config["IDENTITY_CACHE_SIZE"], app.config["IDENTITY_CACHE_TTL"]
+    )
+
+    from app.tag_index import TagPrefixIndex
+
+    app.tag_index = TagPrefixIndex(
+        app.config["TAG_INDEX_SIZE"], app.config["TAG_INDEX_TTL"]
+    )
+
     from app.errors import bp as errors_bp
 
     app.register_blueprint(errors_bp)
@@ -0,0 +1,125 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from sqlalchemy import bindparam
+
+from app import db
+from app.models import User
+
+
+class LastSeenBuffer:
+    """Coalesce the last_seen updates of the users of a process
+
+    Requests only record activity in memory. The buffer is written to the user
+    table in one bulk UPDATE at most every `flush_interval` seconds, and a user
+    is recorded again only once its last_seen is `granularity` seconds old.
+    Once started, a thread also flushes every `flush_interval` seconds, and
+    once more when the process exits, so that no activity stays buffered
+    longer in an idle or recycled worker.
+    """
+
+    def __init__(self, granularity: int = 60, flush_interval: int = 30):
+        self.granularity = timedelta(seconds=granularity)
+        self.flush_interval = flush_interval
+        self._pending = {}
+        # Values written by the last flushes, as the last_seen of the cached
+        # users is not refreshed by the bulk UPDATE
+        self._written = {}
+        self._lock = Lock()
+        self._last_flush = monotonic()
+        self._stopped = Event()
+
+    def start(self, app):
+        """Flush from a daemon thread and at exit, in contexts of `app`"""
+        thread = Thread(
+            target=self._run, args=(app,), name="last-seen-flush", daemon=True
+        )
+        thread.start()
+        atexit.register(self.stop, app)
+
+    def stop(self, app):
+        self._stopped.set()
+        self._flush_in_context(app)
+
+    def _run(self, app):
+        while not self._stopped.wait(self.flush_interval):
+            self._flush_in_context(app)
+
+    def _flush_in_context(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Failed to write last_seen")
+
+    def touch(self, user_id: int, last_seen: datetime = None, now: datetime = None):
+        """Record that a user is active, `last_seen` being its stored value"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            previous = self._pending.get(user_id) or self._written.get(user_id)
+            if previous is None or (last_seen is not None and last_seen > previous):
+                previous = last_seen
+            if previous is not None and now - previous < self.granularity:
+                return
+            self._pending[user_id] = now
+
+    def get(self, user_id: int) -> datetime:
+        """Activity of a user which is not written yet, if any"""
+        return self._pending.get(user_id)
+
+    def maybe_flush(self) -> int:
+        """Flush once `flush_interval` seconds passed since the last flush"""
+        if monotonic() - self._last_flush < self.flush_interval:
+            return 0
+        return self.flush()
+
+    def flush(self) -> int:
+        """Write the pending last_seen values in one bulk UPDATE
+
+        Runs on its own connection, so that it never commits the work of the
+        request which triggers it.
+
+        Returns:
+            [int]: number of users written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = monotonic()
+            # Older values are past the granularity anyway
+            now = datetime.utcnow()
+            self._written = {
+                user_id: last_seen
+                for user_id, last_seen in self._written.items()
+                if now - last_seen < self.granularity
+            }
+            self._written.update(pending)
+        if not pending:
+            return 0
+        table = User.__table__
+        stmt = (
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .where(
+                (table.c.last_seen.is_(None))
+                | (table.c.last_seen < bindparam("_last_seen"))
+            )
+            .values(last_seen=bindparam("_last_seen"))
+        )
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    stmt,
+                    [
+                        {"_id": user_id, "_last_seen": last_seen}
+                        for user_id, last_seen in pending.items()
+                    ],
+                )
+        except Exception:
+            # Kept for the next flush, unless the user was seen since
+            with self._lock:
+                for user_id, last_seen in pending.items():
+                    self._pending.setdefault(user_id, last_seen)
+            raise
+        return len(pending)
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint("api", __name__)
 
-from app.api import cards, users, errors, tokens  # noqa: F401
+from app.api import cards, tags, users, errors, tokens  # noqa: F401
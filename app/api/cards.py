@@ -5,6 +5,7 @@ from app.api import bp
 from app.api.auth import token_auth
 from app import db
 from app.api.errors import bad_request
+from app.api.serializers import card_page, collection_dict, get_page_args, json_response
 
 
 @bp.route("/cards/<int:id>", methods=["GET"])
@@ -20,16 +21,11 @@ def get_card(id):
 def get_cards(user_id):
     if token_auth.current_user().id != user_id:
         abort(403)
-    page = request.args.get("page", 1, type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-    data = Card.to_collection_dict(
-        Card.query.filter_by(user_id=user_id),
-        page,
-        per_page,
-        "api.get_cards",
-        user_id=user_id,
+    page, per_page = get_page_args()
+    items, total = card_page(token_auth.current_user(), page, per_page)
+    return json_response(
+        collection_dict(items, total, page, per_page, "api.get_cards", user_id=user_id)
     )
-    return jsonify(data)
 
 
 @bp.route("/cards/user/<int:user_id>", methods=["POST"])
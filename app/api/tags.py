@@ -0,0 +1,27 @@
+from flask import jsonify, abort
+
+from app.models import Tag
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.serializers import collection_dict, get_page_args, json_response, tag_page
+
+
+@bp.route("/tags/<int:id>", methods=["GET"])
+@token_auth.login_required
+def get_tag(id):
+    tag = Tag.query.get_or_404(id)
+    if token_auth.current_user().id != tag.user_id:
+        abort(403)
+    return jsonify(tag.to_dict())
+
+
+@bp.route("/tags/user/<int:user_id>", methods=["GET"])
+@token_auth.login_required
+def get_tags(user_id):
+    if token_auth.current_user().id != user_id:
+        abort(403)
+    page, per_page = get_page_args()
+    items, total = tag_page(token_auth.current_user(), page, per_page)
+    return json_response(
+        collection_dict(items, total, page, per_page, "api.get_tags", user_id=user_id)
+    )
@@ -1,10 +1,11 @@
 from flask import jsonify, request, url_for, abort
 
-from app.models import User, Card
+from app.models import User
 from app.api import bp
 from app import db
 from app.api.errors import bad_request
 from app.api.auth import token_auth
+from app.api.serializers import card_page, collection_dict, get_page_args, json_response
 
 
 @bp.route("/users/<int:id>", methods=["GET"])
@@ -20,13 +21,11 @@ def get_user(id):
 def get_user_cards(id):
     if token_auth.current_user().id != id:
         abort(403)
-    page = request.args.get("page", 1, type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-    user = User.query.get_or_404(id)
-    data = Card.to_collection_dict(
-        user.cards, page, per_page, "api.get_user_cards", id=id
+    page, per_page = get_page_args()
+    items, total = card_page(token_auth.current_user(), page, per_page)
+    return json_response(
+        collection_dict(items, total, page, per_page, "api.get_user_cards", id=id)
     )
-    return jsonify(data)
 
 
 @bp.route("/users", methods=["POST"])
@@ -0,0 +1,86 @@
+"""Throughput benchmark of the bulk rescheduling engine
+
+Runs against a throw-away SQLite database filled with synthetic cards:
+    python -m app.app_scripts.benchmark_reschedule --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .. import create_app, db
+from ..models import LearnSpacedRepetition
+from ..rescheduling import compute_next_dates, reschedule
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--rows", type=int, default=200000)
+parser.add_argument("--chunk-size", type=int, default=10000)
+args = parser.parse_args()
+
+
+def scalar_next_date(bucket, next_date, old_intervals, new_intervals, today):
+    # Per-row equivalent of compute_next_dates, as done through the ORM
+    if bucket >= LearnSpacedRepetition.get_max_bucket():
+        return None
+    if next_date is None:
+        return today
+    bucket = min(max(bucket, 0), len(new_intervals) - 1)
+    return next_date + timedelta(days=new_intervals[bucket] - old_intervals[bucket])
+
+
+def report(name, rows, seconds):
+    print(
+        f"{name:<32} {rows:>10} rows {seconds:>8.3f} s {rows / seconds:>14,.0f} rows/s"
+    )
+
+
+app = create_app()
+# Never touch the configured database, the engine follows the new URI
+db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+old_intervals = LearnSpacedRepetition.INTERVAL_DAYS
+new_intervals = (0, 1, 2, 3, 5, 8)
+rng = np.random.default_rng(0)
+buckets = rng.integers(1, LearnSpacedRepetition.get_max_bucket() + 1, args.rows)
+offsets = rng.integers(-30, 30, args.rows)
+today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+next_dates = [today + timedelta(days=int(offset)) for offset in offsets]
+next_dates[::100] = [None] * len(next_dates[::100])
+
+# In-memory computation only
+start = time.perf_counter()
+for bucket, next_date in zip(buckets.tolist(), next_dates):
+    scalar_next_date(bucket, next_date, old_intervals, new_intervals, today)
+report("compute, per row", args.rows, time.perf_counter() - start)
+
+next_dates_array = np.array(next_dates, dtype="datetime64[us]").astype("datetime64[D]")
+start = time.perf_counter()
+compute_next_dates(
+    buckets,
+    next_dates_array,
+    old_intervals,
+    new_intervals,
+    np.datetime64(today.date(), "D"),
+)
+report("compute, vectorized", args.rows, time.perf_counter() - start)
+
+# End to end, including reads and bulk writes
+with app.app_context():
+    db.create_all()
+    table = LearnSpacedRepetition.__table__
+    db.session.execute(
+        table.insert(),
+        [
+            {"bucket": bucket, "next_date": next_date, "timestamp": today}
+            for bucket, next_date in zip(buckets.tolist(), next_dates)
+        ],
+    )
+    db.session.commit()
+    start = time.perf_counter()
+    stats = reschedule(old_intervals, new_intervals, chunk_size=args.chunk_size)
+    report("reschedule, SQLite end to end", args.rows, time.perf_counter() - start)
+    print(f"Updated {stats['updated']} of {stats['scanned']} cards")
+os.remove(db_path)
@@ -0,0 +1,134 @@
+"""Latency benchmark of the search backends on a synthetic corpus
+
+Runs against a throw-away SQLite database, or the throw-away database given
+with --database-url, and against Elasticsearch when ELASTICSEARCH_URL is set:
+    python -m app.app_scripts.benchmark_search --cards 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .. import create_app, db
+from ..models import Card, User
+from ..search import bulk_index
+from ..search_backends import create_backend, ElasticsearchBackend
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--cards", type=int, default=100000)
+parser.add_argument("--users", type=int, default=10)
+parser.add_argument("--queries", type=int, default=200)
+parser.add_argument("--per-page", type=int, default=6)
+parser.add_argument(
+    "--database-url", help="Database to fill and drop, never a real one"
+)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+# Zipf distributed words, as in natural text
+VOCABULARY = np.array([f"word{i}" for i in range(20000)])
+
+
+def words(size):
+    ranks = np.minimum(rng.zipf(1.2, size), len(VOCABULARY)) - 1
+    return " ".join(VOCABULARY[ranks])
+
+
+def generate_cards(num_cards, num_users):
+    for i in range(num_cards):
+        yield {
+            "front": words(4),
+            "back": words(30),
+            "user_id": i % num_users + 1,
+        }
+
+
+def measure(backend, index, queries):
+    latencies = []
+    hits = 0
+    for user_id, query in queries:
+        start = time.perf_counter()
+        _, total = backend.query_index(index, query, 1, args.per_page, user_id)
+        latencies.append(time.perf_counter() - start)
+        hits += total
+    latencies = np.array(latencies) * 1000
+    return (
+        f"mean {latencies.mean():.2f} ms, p95 {np.percentile(latencies, 95):.2f} ms, "
+        f"{hits / len(queries):.0f} hits per query"
+    )
+
+
+app = create_app()
+db_path = None
+if args.database_url:
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_url
+else:
+    # Never touch the configured database, the engine follows the new URI
+    db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+
+with app.app_context():
+    db.create_all()
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {"username": f"user{i}", "email": f"user{i}@example.com"}
+            for i in range(1, args.users + 1)
+        ],
+    )
+    start = time.perf_counter()
+    rows = []
+    for row in generate_cards(args.cards, args.users):
+        rows.append(row)
+        if len(rows) == 10000:
+            db.session.execute(Card.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Card.__table__.insert(), rows)
+    db.session.commit()
+    print(
+        f"Inserted and indexed {args.cards} cards in the database in "
+        f"{time.perf_counter() - start:.1f} s"
+    )
+    queries = [
+        (int(rng.integers(1, args.users + 1)), words(2)) for _ in range(args.queries)
+    ]
+
+    backend = create_backend("database", db.engine.dialect.name)
+    print(f"[{type(backend).__name__}] {measure(backend, 'card', queries)}")
+
+    if app.elasticsearch:
+        index = f"benchmark_card_{os.getpid()}"
+        app.elasticsearch.indices.create(
+            index=index, body={"mappings": Card.get_mapping()}
+        )
+        start = time.perf_counter()
+        columns = Card.get_document_columns()
+        last_id = 0
+        while True:
+            chunk = db.session.execute(
+                db.select([Card.__table__.c.id] + columns)
+                .where(Card.__table__.c.id > last_id)
+                .order_by(Card.__table__.c.id)
+                .limit(5000)
+            ).fetchall()
+            if not chunk:
+                break
+            bulk_index(index, list(Card.to_documents(chunk).items()))
+            last_id = chunk[-1].id
+        app.elasticsearch.indices.refresh(index=index)
+        print(
+            f"Indexed {args.cards} cards in Elasticsearch in "
+            f"{time.perf_counter() - start:.1f} s"
+        )
+        print(
+            f"[ElasticsearchBackend] {measure(ElasticsearchBackend(), index, queries)}"
+        )
+        app.elasticsearch.indices.delete(index=index)
+
+    db.session.remove()
+    db.drop_all()
+if db_path:
+    os.remove(db_path)
@@ -0,0 +1,77 @@
+"""Throughput benchmark of the scheduling simulator
+
+Runs against a throw-away SQLite database filled with a synthetic history:
+    python -m app.app_scripts.benchmark_simulation --facts 2000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .. import create_app, db
+from ..models import LearningSessionFact
+from ..simulation import IntervalScheduler, simulate, DEFAULT_CHUNK_SIZE
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--facts", type=int, default=1000000)
+parser.add_argument("--reviews-per-card", type=int, default=20)
+parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+args = parser.parse_args()
+
+
+def generate_history(num_facts, reviews_per_card, seed=0):
+    """Synthetic answered facts, as rows ready to be inserted"""
+    rng = np.random.default_rng(seed)
+    card_ids = np.sort(rng.integers(1, num_facts // reviews_per_card + 2, num_facts))
+    day_offsets = rng.integers(0, 365, num_facts)
+    is_ok = rng.random(num_facts) < 0.8
+    start = datetime(2021, 1, 1)
+    for i in range(num_facts):
+        complete_at = start + timedelta(days=int(day_offsets[i]))
+        yield {
+            "ls_id": 1,
+            "user_id": 1,
+            "card_id": int(card_ids[i]),
+            "number": 1,
+            "created_at": complete_at,
+            "complete_at": complete_at,
+            "is_ok": bool(is_ok[i]),
+        }
+
+
+app = create_app()
+# Never touch the configured database, the engine follows the new URI
+db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+
+with app.app_context():
+    db.create_all()
+    table = LearningSessionFact.__table__
+    rows = []
+    for row in generate_history(args.facts, args.reviews_per_card):
+        rows.append(row)
+        if len(rows) == 50000:
+            db.session.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+
+    schedulers = [IntervalScheduler(), IntervalScheduler((0, 1, 2, 3, 5, 8))]
+    start = time.perf_counter()
+    report = simulate(schedulers, chunk_size=args.chunk_size)
+    seconds = time.perf_counter() - start
+    print(
+        f"Replayed {report['num_facts']} facts through {len(schedulers)} "
+        f"schedulers in {seconds:.3f} s, "
+        f"{report['num_facts'] / seconds:,.0f} facts/s"
+    )
+    for result in report["schedulers"]:
+        print(
+            f"[{result['scheduler']}] mastery rate {result['mastery_rate']:.1%}, "
+            f"max {result['daily_workload']['max']} reviews per day"
+        )
+os.remove(db_path)
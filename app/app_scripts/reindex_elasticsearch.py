@@ -1,10 +1,60 @@
+import argparse
+import os
+
 from .. import create_app
-from ..models import Card, Tag
+from ..reindexing import rebuild, reindex, DEFAULT_CHUNK_SIZE
 from config import config
 
+parser = argparse.ArgumentParser(
+    description="Rebuild the search indexes into new versions, then swap them"
+)
+parser.add_argument(
+    "--index", action="append", choices=["card", "tag"], help="Default: all"
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Processes indexing id ranges in parallel",
+)
+parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+parser.add_argument(
+    "--checkpoint-dir",
+    help="Save the progress there, and resume from it if it exists",
+)
+parser.add_argument(
+    "--in-place",
+    action="store_true",
+    help="Write to the live indexes instead of new versions",
+)
+parser.add_argument(
+    "--keep-old", action="store_true", help="Keep the previous versions"
+)
+args = parser.parse_args()
+
 app = create_app()
 app.config.from_object(config["default"])
 
-with app.app_context():
-    Card.reindex()
-    Tag.reindex()
+# Worker processes may import this module again
+if __name__ == "__main__" and not app.elasticsearch:
+    # The database search backends index in the database itself
+    app.logger.info("ELASTICSEARCH_URL is not set, nothing to reindex")
+elif __name__ == "__main__":
+    with app.app_context():
+        indexes = args.index or ["card", "tag"]
+        if args.in_place:
+            counts = reindex(
+                indexes,
+                workers=args.workers,
+                chunk_size=args.chunk_size,
+                checkpoint_dir=args.checkpoint_dir,
+            )
+        else:
+            counts = rebuild(
+                indexes,
+                workers=args.workers,
+                chunk_size=args.chunk_size,
+                checkpoint_dir=args.checkpoint_dir,
+                keep_old=args.keep_old,
+            )
+        app.logger.info(f"Reindexed {counts}")
@@ -0,0 +1,11 @@
+from .. import create_app
+from ..models import UserStats
+from config import config
+
+app = create_app()
+app.config.from_object(config["default"])
+
+with app.app_context():
+    app.logger.info("Recomputing the card and tag counts of every user...")
+    num_repaired = UserStats.repair()
+    app.logger.info(f"Repaired the counts of {num_repaired} users")
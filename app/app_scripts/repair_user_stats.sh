@@ -0,0 +1,11 @@
+#!/bin/sh
+# Environment: Inside app
+# Function: Recompute the card and tag counts of every user
+# Run command: docker-compose exec -w '/home/alpine/app/app_scripts' alpine ./repair_user_stats.sh
+
+APP_DIR='/home/alpine'
+
+source $APP_DIR/alpine/bin/activate
+cd $APP_DIR
+
+python -m app.app_scripts.repair_user_stats
@@ -0,0 +1,18 @@
+import argparse
+
+from .. import create_app
+from ..models import SearchIndexOutbox
+from config import config
+
+parser = argparse.ArgumentParser(
+    description="Retry the search index changes the outbox drain gave up on"
+)
+parser.add_argument("--index", choices=["card", "tag"], help="Default: all")
+args = parser.parse_args()
+
+app = create_app()
+app.config.from_object(config["default"])
+
+with app.app_context():
+    num_requeued = SearchIndexOutbox.requeue(args.index)
+    app.logger.info(f"Requeued {num_requeued} search index changes")
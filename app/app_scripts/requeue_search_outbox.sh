@@ -0,0 +1,11 @@
+#!/bin/sh
+# Environment: Inside app
+# Function: Retry the search index changes the outbox drain gave up on
+# Run command: docker-compose exec -w '/home/alpine/app/app_scripts' alpine ./requeue_search_outbox.sh [--index card]
+
+APP_DIR='/home/alpine'
+
+source $APP_DIR/alpine/bin/activate
+cd $APP_DIR
+
+python -m app.app_scripts.requeue_search_outbox "$@"
@@ -0,0 +1,48 @@
+import argparse
+
+from .. import create_app
+from ..models import LearnSpacedRepetition
+from ..rescheduling import reschedule, DEFAULT_CHUNK_SIZE
+from config import config
+
+
+def parse_intervals(value):
+    return tuple(int(day) for day in value.split(","))
+
+
+parser = argparse.ArgumentParser(
+    description="Reschedule the next learning date of every card"
+)
+parser.add_argument(
+    "--old-intervals",
+    type=parse_intervals,
+    default=LearnSpacedRepetition.INTERVAL_DAYS,
+    help="Comma separated days per bucket the current dates were computed with",
+)
+parser.add_argument(
+    "--new-intervals",
+    type=parse_intervals,
+    default=LearnSpacedRepetition.INTERVAL_DAYS,
+    help="Comma separated days per bucket to reschedule with",
+)
+parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+parser.add_argument("--dry-run", action="store_true")
+args = parser.parse_args()
+
+app = create_app()
+app.config.from_object(config["default"])
+
+with app.app_context():
+    app.logger.info(
+        f"Rescheduling cards from intervals {args.old_intervals} "
+        f"to {args.new_intervals} (dry run: {args.dry_run})..."
+    )
+    stats = reschedule(
+        old_intervals=args.old_intervals,
+        new_intervals=args.new_intervals,
+        chunk_size=args.chunk_size,
+        dry_run=args.dry_run,
+    )
+    app.logger.info(
+        f"Scanned {stats['scanned']} cards, updated {stats['updated']} cards"
+    )
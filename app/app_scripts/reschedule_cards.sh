@@ -0,0 +1,12 @@
+#!/bin/sh
+# Environment: Inside app
+# Function: Reschedule the next learning date of every card, e.g. after changing
+#   LearnSpacedRepetition.INTERVAL_DAYS or to repair invalid next dates
+# Run command: docker-compose exec -w '/home/alpine/app/app_scripts' alpine ./reschedule_cards.sh --dry-run
+
+APP_DIR='/home/alpine'
+
+source $APP_DIR/alpine/bin/activate
+cd $APP_DIR
+
+python -m app.app_scripts.reschedule_cards "$@"
@@ -0,0 +1,53 @@
+import argparse
+
+from .. import create_app
+from ..models import LearnSpacedRepetition
+from ..simulation import IntervalScheduler, simulate, DEFAULT_CHUNK_SIZE
+from config import config
+
+
+def parse_intervals(value):
+    return tuple(int(day) for day in value.split(","))
+
+
+parser = argparse.ArgumentParser(
+    description="Replay the review history through alternative interval tables"
+)
+parser.add_argument(
+    "--intervals",
+    type=parse_intervals,
+    action="append",
+    help="Comma separated days per bucket, can be repeated to compare tables",
+)
+parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+args = parser.parse_args()
+
+app = create_app()
+app.config.from_object(config["default"])
+
+with app.app_context():
+    # The current table always comes first, as the baseline
+    tables = [LearnSpacedRepetition.INTERVAL_DAYS] + [
+        intervals
+        for intervals in args.intervals or []
+        if intervals != LearnSpacedRepetition.INTERVAL_DAYS
+    ]
+    app.logger.info(f"Simulating interval tables {tables}...")
+    report = simulate(
+        [IntervalScheduler(intervals) for intervals in tables],
+        chunk_size=args.chunk_size,
+    )
+    actual = report["actual_daily_workload"]
+    app.logger.info(
+        f"Replayed {report['num_facts']} facts, actual reviews per active day: "
+        f"mean {actual['mean']:.1f}, p95 {actual['p95']:.0f}, max {actual['max']}"
+    )
+    for result in report["schedulers"]:
+        workload = result["daily_workload"]
+        app.logger.info(
+            f"[{result['scheduler']}] reviews per active day: "
+            f"mean {workload['mean']:.1f}, p95 {workload['p95']:.0f}, "
+            f"max {workload['max']} | mastered {result['num_mastered']} "
+            f"of {result['num_cards']} cards ({result['mastery_rate']:.1%}), "
+            f"{result['mean_reviews_to_mastery'] or 0:.1f} reviews on average"
+        )
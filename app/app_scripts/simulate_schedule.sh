@@ -0,0 +1,12 @@
+#!/bin/sh
+# Environment: Inside app
+# Function: Replay the review history through alternative interval tables, and
+#   report the projected daily workload and mastery rate of each of them
+# Run command: docker-compose exec -w '/home/alpine/app/app_scripts' alpine ./simulate_schedule.sh --intervals 0,1,2,3,5,8
+
+APP_DIR='/home/alpine'
+
+source $APP_DIR/alpine/bin/activate
+cd $APP_DIR
+
+python -m app.app_scripts.simulate_schedule "$@"
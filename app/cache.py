@@ -0,0 +1,81 @@
+import json
+from time import time
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+# Seconds to stop calling Redis after it failed, so that an outage neither
+# slows down every request nor floods the logs
+RETRY_AFTER = 30
+_unavailable_until = 0
+
+
+def _call(func, *args, **kwargs):
+    """Call Redis, None if it is unavailable"""
+    global _unavailable_until
+    if time() < _unavailable_until:
+        return None
+    try:
+        return func(*args, **kwargs)
+    except RedisError as e:
+        _unavailable_until = time() + RETRY_AFTER
+        current_app.logger.warning(f"Cache unavailable: {e}")
+        return None
+
+
+def _generation_key(user_id, kind=None):
+    if kind is None:
+        return f"user:{user_id}:generation"
+    return f"user:{user_id}:{kind}_generation"
+
+
+def get_generation(user_id, kind=None):
+    """Return the cache generation of a user, None if Redis is unavailable
+
+    Every cached value of a user is keyed by its generation, bumping it drops
+    them all at once. A `kind` of values, e.g. "identity", has its own
+    generation.
+    """
+    generation = _call(current_app.redis.get, _generation_key(user_id, kind))
+    if time() < _unavailable_until:
+        return None
+    return int(generation or 0)
+
+
+def bump_generation(user_ids, kind=None):
+    if not user_ids:
+        return
+    pipe = current_app.redis.pipeline()
+    for user_id in user_ids:
+        pipe.incr(_generation_key(user_id, kind))
+    _call(pipe.execute)
+
+
+def user_key(user_id, name, *parts, kind=None):
+    """Build the key of a cached value of a user, None if Redis is unavailable
+
+    The key holds the generation of the values of `kind`, the shared one by
+    default.
+    """
+    generation = get_generation(user_id, kind)
+    if generation is None:
+        return None
+    return ":".join(str(part) for part in ("user", user_id, generation, name) + parts)
+
+
+def get(key):
+    if key is None:
+        return None
+    value = _call(current_app.redis.get, key)
+    return json.loads(value) if value is not None else None
+
+
+def set(key, value, ttl=None):
+    if key is None:
+        return
+    _call(
+        current_app.redis.set,
+        key,
+        json.dumps(value),
+        ex=ttl or current_app.config["CACHE_TTL"],
+    )
@@ -0,0 +1,61 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func
+
+from app import cache, db
+from app.models import Card, LearnSpacedRepetition, Tagging
+
+MAX_FORECAST_DAYS = 90
+
+
+def compute_forecast(user_id: int, days: int, tag_id: int = None, today=None):
+    """Count the cards due on each of the next `days` days
+
+    A single GROUP BY over the next dates of the user's cards. Overdue cards
+    are counted today, mastered cards never.
+
+    Returns:
+        [list]: one {"date", "num_due"} per day, starting today
+    """
+    today = today or datetime.utcnow().date()
+    start = datetime.combine(today, datetime.min.time())
+    end = start + timedelta(days=days)
+    next_date = LearnSpacedRepetition.next_date
+    due_day = func.date(db.case([(next_date < start, start)], else_=next_date))
+    query = (
+        db.session.query(due_day, func.count(Card.id))
+        .join(
+            LearnSpacedRepetition, Card.learn_spaced_rep_id == LearnSpacedRepetition.id
+        )
+        .filter(Card.user_id == user_id)
+        .filter(next_date < end)
+        .filter(LearnSpacedRepetition.bucket < LearnSpacedRepetition.get_max_bucket())
+    )
+    if tag_id is not None:
+        query = query.join(Tagging, Tagging.card_id == Card.id).filter(
+            Tagging.tag_id == tag_id
+        )
+    counts = {}
+    for day, num_due in query.group_by(due_day):
+        # SQLite returns the date as a string
+        if isinstance(day, str):
+            day = date.fromisoformat(day)
+        counts[day] = num_due
+    return [
+        {
+            "date": (today + timedelta(days=i)).isoformat(),
+            "num_due": counts.get(today + timedelta(days=i), 0),
+        }
+        for i in range(days)
+    ]
+
+
+def get_forecast(user_id: int, days: int, tag_id: int = None):
+    """Cached compute_forecast, until the user reviews or edits a card"""
+    today = datetime.utcnow().date()
+    key = cache.user_key(user_id, "forecast", today.isoformat(), days, tag_id)
+    forecast = cache.get(key)
+    if forecast is None:
+        forecast = compute_forecast(user_id, days, tag_id, today)
+        cache.set(key, forecast)
+    return forecast
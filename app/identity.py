@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from time import monotonic
+
+
+class IdentityCache:
+    """Per-process TTL and LRU cache of the users seen by login and token auth
+
+    Entries are column snapshots, never ORM instances, so that they can be
+    shared by the sessions of all the threads. A snapshot is only valid at
+    the identity generation of its user it was taken at, so that the commits
+    of the other processes drop it too. Tokens are only kept hashed and map
+    to a user id, the token of the user is checked on every hit.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def hash_token(token: str) -> str:
+        return sha256(token.encode("utf-8")).hexdigest()
+
+    def _get(self, key, generation=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < monotonic() or entry[1] != generation:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def _set(self, key, value, generation=None):
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_user(self, user_id: int, generation=None) -> dict:
+        return self._get(("id", user_id), generation)
+
+    def set_user(self, user_id: int, snapshot: dict, generation=None):
+        self._set(("id", user_id), snapshot, generation)
+
+    def get_token_user_id(self, token: str) -> int:
+        return self._get(("token", self.hash_token(token)))
+
+    def set_token(self, token: str, user_id: int):
+        self._set(("token", self.hash_token(token)), user_id)
+
+    def invalidate(self, user_ids):
+        """Drop the users, their tokens are dropped with their snapshot"""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(("id", user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,16 +1,29 @@
 from typing import List
 from datetime import datetime, timedelta
-import random
 
 from flask_login import current_user
 from flask import current_app
 from sqlalchemy import func
-
-from app.models import Card, LearningSessionFact, LearnSpacedRepetition, Tagging
+from sqlalchemy.orm import joinedload
+
+from app.models import (
+    Card,
+    LearningSession,
+    LearningSessionFact,
+    LearningSessionState,
+    LearnSpacedRepetition,
+    Tagging,
+)
 from app import db
+from app.cache import bump_generation
 
 AVG_CARD_DURATION_SEC = 60
 SESSION_EXPIRE_MINUTE = 5
+SAMPLING_RANDOM = "random"
+SAMPLING_PRIORITY = "priority"
+MAX_BATCH_RESULTS = 500
+DEFAULT_PREFETCH = 10
+MAX_PREFETCH = 50
 
 
 class LearningHelper:
@@ -20,9 +33,11 @@ class LearningHelper:
         learn_date=datetime.today(),
         tag_id=[],
         user=current_user,
+        sampling=SAMPLING_RANDOM,
     ):
         self.user = user
         self.num_learn = num_learn
+        self.sampling = sampling
         # Change learn_date to end of day
         self.learn_date = learn_date.replace(hour=23, minute=59, second=59)
         self.tag_id = tag_id
@@ -52,10 +67,27 @@ class LearningHelper:
         self._build()
         return self
 
+    def load_new_session_stats(self):
+        """Fill in the stats of a new session without loading its cards
+
+        Only a COUNT is run against the due queue, which is enough for pages that
+        display how many cards are due.
+        """
+        num_total = self.count_due_cards()
+        if self.num_learn is not None:
+            num_total = min(num_total, self.num_learn)
+        self.stats = {
+            "num_total": num_total,
+            "num_minutes": self._calc_duration(num_total),
+        }
+        return self
+
+    def count_due_cards(self) -> int:
+        return self._due_cards_query().order_by(None).count()
+
     def load_current_session(self):
-        ls_id = self.user.current_ls_id
-        self.current_ls_id = ls_id
-        self.ls_facts = LearningSessionFact.query.filter_by(ls_id=ls_id).all()
+        self.current_ls_id = self.user.current_ls_id
+        self.ls_facts = self._current_lsf_query().all()
         ls_facts_left = [lsf for lsf in self.ls_facts if lsf.complete_at is None]
         self.stats = {
             "num_total": len(ls_facts_left),
@@ -63,12 +95,14 @@ class LearningHelper:
         }
         self.cards = [lsf.card for lsf in ls_facts_left]
 
-    def init_session(self, write_new_session=False):
+    def init_session(self, write_new_session=False, count_only=False):
         last_session_status = self.get_last_session_status()
         current_app.logger.info(
             f"uid {self.user.id}: last_session_status = {last_session_status}"
         )
         if last_session_status in ["complete", "expire", "outdated"]:
+            if count_only:
+                return self.load_new_session_stats()
             self.load_new_session()
             if write_new_session:
                 self._write_new_session()
@@ -77,110 +111,248 @@ class LearningHelper:
         return self
 
     def get_last_session_status(self):
-        ls_id = self.user.current_ls_id
+        state = self.user.ls_state
         if (
-            ls_id is None
-            or self.user.ls_facts.first() is None
-            or self._session_complete(ls_id)
+            state is None
+            or state.ls_id != self.user.current_ls_id
+            or state.is_complete()
         ):
             return "complete"
-        user_latest_card_time = current_user.get_latest_card().timestamp
-        ls_last_created_time = (
-            LearningSessionFact.query.filter_by(ls_id=ls_id).first().created_at
-        )
-        if user_latest_card_time > ls_last_created_time:
+        if state.status == LearningSessionState.STATUS_OUTDATED:
             return "outdated"
-        if self._session_expire(ls_id):
+        if self._session_expire(state):
             return "expire"
         else:
             return "still"
 
     def get_current_lsf(self):
-        ls_id = self.user.current_ls_id
-        lsf_query = LearningSessionFact.query.filter_by(ls_id=ls_id)
         current_lsf = (
-            lsf_query.filter_by(is_ok=None)
+            self._current_lsf_query()
+            .filter_by(is_ok=None)
+            .options(joinedload(LearningSessionFact.card).selectinload(Card.all_tags))
             .order_by(LearningSessionFact.number.asc())
             .first()
         )
-        current_app.logger.info(f"user ls_id: {ls_id}")
+        current_app.logger.info(f"user ls_id: {self.user.current_ls_id}")
         return current_lsf
 
+    def get_pending_lsfs(self, limit: int) -> List[LearningSessionFact]:
+        """Load the next unanswered facts of the current session
+
+        Their cards and schedules are joined eagerly and the tags of all the
+        cards are loaded with one more query, whatever the number of cards.
+        """
+        card = joinedload(LearningSessionFact.card)
+        return (
+            self._current_lsf_query()
+            .filter_by(is_ok=None)
+            .options(
+                card.joinedload(Card.learn_spaced_rep),
+                card.selectinload(Card.all_tags),
+            )
+            .order_by(LearningSessionFact.number.asc())
+            .limit(limit)
+            .all()
+        )
+
+    @staticmethod
+    def complete_lsf(lsf: LearningSessionFact, is_ok: bool):
+        """Record the answer of a card and keep the session state in sync"""
+        already_complete = lsf.complete_at is not None
+        if is_ok:
+            LearningHelper.handle_ok(lsf)
+        else:
+            LearningHelper.handle_fail(lsf)
+        lsf.complete_at = datetime.utcnow()
+        state = lsf.user.ls_state
+        if not already_complete and state is not None and state.ls_id == lsf.ls_id:
+            state.record_complete(lsf.complete_at)
+
+    @staticmethod
+    def complete_lsf_batch(user, results: List[dict]) -> dict:
+        """Record many answers of a learning session in one transaction
+
+        The affected facts and spaced repetition states are read with one query
+        and written back with bulk UPDATEs.
+
+        Args:
+            user (User): owner of the learning session facts
+            results (List[dict]): items with keys lsf_id, is_ok and optionally
+                start_at and complete_at
+
+        Returns:
+            [dict]: new scheduling state per answered fact and the ids of the
+                facts which were not found
+        """
+        lsf_ids = [result["lsf_id"] for result in results]
+        rows = (
+            db.session.query(
+                LearningSessionFact.id,
+                LearningSessionFact.ls_id,
+                LearningSessionFact.card_id,
+                LearningSessionFact.complete_at,
+                LearnSpacedRepetition.id.label("lsr_id"),
+                LearnSpacedRepetition.bucket,
+                LearnSpacedRepetition.next_date,
+            )
+            .join(Card, LearningSessionFact.card_id == Card.id)
+            .join(
+                LearnSpacedRepetition,
+                Card.learn_spaced_rep_id == LearnSpacedRepetition.id,
+            )
+            .filter(LearningSessionFact.id.in_(lsf_ids))
+            .filter(LearningSessionFact.user_id == user.id)
+            .all()
+        )
+        facts = {row.id: row for row in rows}
+        # Answers of the same card are applied in order on the latest state
+        lsr_states = {
+            row.lsr_id: {
+                "id": row.lsr_id,
+                "bucket": row.bucket,
+                "next_date": row.next_date,
+            }
+            for row in rows
+        }
+        lsf_mappings = {}
+        data, not_found = [], []
+        state = user.ls_state
+        num_newly_complete, last_complete_at = 0, None
+        for result in results:
+            fact = facts.get(result["lsf_id"])
+            if fact is None:
+                not_found.append(result["lsf_id"])
+                continue
+            lsf_id = fact.id
+            lsr_state = lsr_states[fact.lsr_id]
+            bucket, next_date = LearningHelper.get_next_schedule(
+                lsr_state["bucket"], lsr_state["next_date"], result["is_ok"]
+            )
+            lsr_state["bucket"] = bucket
+            lsr_state["next_date"] = next_date
+            new_complete_at = result.get("complete_at") or datetime.utcnow()
+            if (
+                fact.complete_at is None
+                and lsf_id not in lsf_mappings
+                and state is not None
+                and state.ls_id == fact.ls_id
+            ):
+                num_newly_complete += 1
+                last_complete_at = max(
+                    new_complete_at, last_complete_at or new_complete_at
+                )
+            lsf_mappings[lsf_id] = {
+                "id": lsf_id,
+                "is_ok": result["is_ok"],
+                "complete_at": new_complete_at,
+            }
+            if result.get("start_at") is not None:
+                lsf_mappings[lsf_id]["start_at"] = result["start_at"]
+            data.append(
+                {
+                    "lsf_id": lsf_id,
+                    "card_id": fact.card_id,
+                    "is_ok": result["is_ok"],
+                    "bucket": bucket,
+                    "next_date": next_date,
+                }
+            )
+        db.session.bulk_update_mappings(
+            LearningSessionFact, list(lsf_mappings.values())
+        )
+        db.session.bulk_update_mappings(
+            LearnSpacedRepetition, list(lsr_states.values())
+        )
+        if num_newly_complete > 0:
+            state.record_complete(last_complete_at, num_newly_complete)
+        db.session.commit()
+        # Bulk updates bypass the session, so the cache is not invalidated
+        if data:
+            bump_generation([user.id])
+        return {"results": data, "not_found": not_found}
+
     @staticmethod
     def handle_fail(lsf: LearningSessionFact):
-        card = lsf.card
-        card.learn_spaced_rep.bucket = 1
-        card.learn_spaced_rep.next_date = datetime.utcnow().date()
+        learn_spaced_rep = lsf.card.learn_spaced_rep
+        bucket, next_date = LearningHelper.get_next_schedule(
+            learn_spaced_rep.bucket, learn_spaced_rep.next_date, False
+        )
+        learn_spaced_rep.bucket = bucket
+        learn_spaced_rep.next_date = next_date
         lsf.is_ok = False
 
     @staticmethod
     def handle_ok(lsf: LearningSessionFact):
-        card = lsf.card
-        card.learn_spaced_rep.bucket = min(6, card.learn_spaced_rep.bucket + 1)
-        LearningHelper._set_card_next_date(card)
+        learn_spaced_rep = lsf.card.learn_spaced_rep
+        bucket, next_date = LearningHelper.get_next_schedule(
+            learn_spaced_rep.bucket, learn_spaced_rep.next_date, True
+        )
+        learn_spaced_rep.bucket = bucket
+        learn_spaced_rep.next_date = next_date
         lsf.is_ok = True
 
+    @staticmethod
+    def get_next_schedule(bucket: int, next_date: datetime, is_ok: bool):
+        """Compute the spaced repetition state of a card after it is answered
+
+        Args:
+            bucket (int): current bucket of the card
+            next_date (datetime): current next learning date of the card
+            is_ok (bool): whether the card was answered correctly
+
+        Returns:
+            [Tuple[int, date]]: new bucket and new next learning date
+        """
+        today = datetime.utcnow().date()
+        if not is_ok:
+            return 1, today
+        max_bucket = LearnSpacedRepetition.get_max_bucket()
+        bucket = min(max_bucket, bucket + 1)
+        if bucket >= max_bucket:
+            return bucket, None
+        plus_next_day = LearnSpacedRepetition._get_day_from_bucket(bucket)
+        if plus_next_day is None:
+            return bucket, None
+        # If make-up card then set next learn date based on today
+        _date = max(next_date.date(), today) if next_date is not None else today
+        return bucket, _date + timedelta(days=plus_next_day)
+
     def get_cards(self, status: str) -> List[LearningSessionFact]:
         """List all the data
 
         Args:
             status (str): {success, fail}
         """
-        lsf_query = LearningSessionFact.query.filter_by(ls_id=self.current_ls_id)
+        lsf_query = self._current_lsf_query()
         if status == "success":
             cards = lsf_query.filter_by(is_ok=True)
         elif status == "fail":
             cards = lsf_query.filter_by(is_ok=False)
         return cards.all()
 
+    def _current_lsf_query(self):
+        learning_session = self.user.get_current_session()
+        if learning_session is None:
+            return LearningSessionFact.query.filter(db.false())
+        return learning_session.ls_facts
+
     def _get_card_pool(self):
         if self.tag_id is not None and len(self.tag_id) > 0:
-            taggings = Tagging.query.filter(Tagging.tag_id.in_(self.tag_id)).all()
-            card_pool = (tagging.card_id for tagging in taggings)
-            card_pool = Card.query.filter(Card.id.in_(card_pool))
-            return card_pool
-        return self.user.cards
-
-    @staticmethod
-    def _set_card_next_date(card: Card):
-        if card.learn_spaced_rep.bucket >= 6:
-            card.learn_spaced_rep.next_date = None
-            return
-        plus_next_day = card.learn_spaced_rep._get_day_from_bucket(
-            card.learn_spaced_rep.bucket
-        )
-        if plus_next_day is not None:
-            # If make-up card then set next learn date based on today
-            _date = max(
-                card.learn_spaced_rep.next_date.date(), datetime.utcnow().date()
+            tagged_card_ids = db.session.query(Tagging.card_id).filter(
+                Tagging.tag_id.in_(self.tag_id)
             )
-            card.learn_spaced_rep.next_date = _date + timedelta(days=plus_next_day)
-        else:
-            card.learn_spaced_rep.next_date = None
-
-    @staticmethod
-    def _session_complete(ls_id: int) -> bool:
-        lsf_query = LearningSessionFact.query.filter_by(ls_id=ls_id)
-        last_ls_fact_created = lsf_query.order_by(LearningSessionFact.id.desc()).first()
-        if last_ls_fact_created.complete_at is not None:
-            return True
+            return self.user.cards.filter(Card.id.in_(tagged_card_ids))
+        return self.user.cards
 
     @staticmethod
-    def _session_expire(ls_id: int) -> bool:
-        lsf_query = LearningSessionFact.query.filter_by(ls_id=ls_id)
-        last_ls_fact_complete = lsf_query.order_by(
-            LearningSessionFact.complete_at.desc()
-        ).first()
-        if last_ls_fact_complete.complete_at:
-            begin_time = last_ls_fact_complete.complete_at
-        else:
-            begin_time = last_ls_fact_complete.created_at
+    def _session_expire(state: LearningSessionState) -> bool:
+        begin_time = state.last_complete_at or state.created_at
         expire_at = begin_time + timedelta(minutes=SESSION_EXPIRE_MINUTE)
         is_expire = datetime.utcnow() > expire_at
         return is_expire
 
-    def _collect_tasks_today(self):
-        cards_query = (
+    def _due_cards_query(self):
+        return (
             self.card_pool.join(
                 LearnSpacedRepetition,
                 Card.learn_spaced_rep_id == LearnSpacedRepetition.id,
@@ -191,17 +363,30 @@ class LearningHelper:
             )
         )
 
-        cards_query = cards_query.all()
-        self.cards.extend(cards_query)
+    def _collect_tasks_today(self):
+        """Select the cards of the session inside the database
 
-    def _build(self):
-        random.shuffle(self.cards)
+        Ordering, sampling and limit are all pushed down to the query, so only
+        the `num_learn` selected cards are ever loaded.
+        """
+        cards_query = self._due_cards_query()
+        if self.sampling == SAMPLING_PRIORITY:
+            # Most overdue first, then the least known ones
+            cards_query = cards_query.order_by(
+                LearnSpacedRepetition.next_date.asc(),
+                LearnSpacedRepetition.bucket.asc(),
+                Card.id.asc(),
+            )
+        else:
+            cards_query = cards_query.order_by(func.random())
         if self.num_learn is not None:
-            self.cards = self.cards[: self.num_learn]
+            cards_query = cards_query.limit(self.num_learn)
+        self.cards.extend(cards_query.all())
+
+    def _build(self):
         self.lsb = LearningSessionBuilder(user=self.user, cards=self.cards)
         self.lsb.build()
         self.stats = self.lsb.stats
-        self.current_ls_id = self.lsb.current_ls_id
         self.ls_facts = self.lsb.ls_facts
 
     @staticmethod
@@ -211,17 +396,15 @@ class LearningHelper:
     def _write_new_session(self):
         if self.lsb is not None:
             self.lsb.write_session_data()
+            self.current_ls_id = self.lsb.current_ls_id
         else:
             raise Exception("LearningSessionBuilder is not defined")
 
     @staticmethod
-    def parse_cards_from_selected_str(cards_str: str) -> List[Card]:
-        cards = cards_str.split(",")
-        if len(cards) == 0:
-            return []
-        cards = cards[1:]
-        cards = [Card.query.get(int(card)) for card in cards]
-        return cards
+    def parse_cards_from_selected_str(cards_str: str, user_id: int) -> List[Card]:
+        """Load the cards of a comma separated id list, e.g. ",1,2", of a user"""
+        card_ids = [card_id for card_id in cards_str.split(",") if card_id.isdigit()]
+        return Card.get_owned_by_ids(card_ids, user_id)
 
 
 class LearningSessionBuilder:
@@ -234,37 +417,43 @@ class LearningSessionBuilder:
             "num_minutes": None,
         }
         self.current_ls_id = None
+        self.learning_session = None
         self.ls_facts = []
 
     def build(self):
         self.stats["num_total"] = len(self.cards)
         self.stats["num_minutes"] = LearningHelper._calc_duration(len(self.cards))
 
-        # build LearningSessionFact
-        current_max_ls_id = db.session.query(
-            func.max(LearningSessionFact.ls_id)
-        ).scalar()
-        if current_max_ls_id is not None:
-            new_ls_id = current_max_ls_id + 1
-        else:
-            new_ls_id = 0
-        self.current_ls_id = new_ls_id
-        created_at = datetime.utcnow()
+        # build LearningSessionFact. The ls_id is only allocated by the database
+        # when the session is written.
+        self.learning_session = LearningSession(
+            user_id=self.user.id, created_at=datetime.utcnow()
+        )
         for number, card in enumerate(self.cards):
             lsf = LearningSessionFact(
-                ls_id=new_ls_id,
+                learning_session=self.learning_session,
                 user_id=self.user.id,
-                created_at=created_at,
-                card=card,
+                created_at=self.learning_session.created_at,
+                card_id=card.id,
                 number=number,
             )
             self.ls_facts.append(lsf)
         return self
 
     def write_session_data(self):
+        db.session.add(self.learning_session)
+        db.session.flush()
+        self.current_ls_id = self.learning_session.id
         self.user.set_current_ls_id(self.current_ls_id)
         current_app.logger.info(f"self.user.current_ls_id: {self.user.current_ls_id}")
+        state = self.user.ls_state
+        if state is None:
+            state = LearningSessionState(user_id=self.user.id)
+        state.reset(
+            self.current_ls_id, self.learning_session.created_at, len(self.ls_facts)
+        )
         db.session.add(self.user)
+        db.session.add(state)
         db.session.add_all(self.ls_facts)
         db.session.commit()
         return self
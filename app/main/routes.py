@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import imghdr
 
@@ -14,6 +14,7 @@ from flask import (
     abort,
 )
 from werkzeug.utils import secure_filename
+from redis.exceptions import RedisError
 from flask_login import current_user, login_required
 
 from app import db
@@ -34,7 +35,16 @@ from app.models import (
     LearningSessionFact,
     LearnSpacedRepetition,
 )
-from app.learning import LearningHelper, LearningSessionBuilder
+from app.learning import (
+    LearningHelper,
+    LearningSessionBuilder,
+    SAMPLING_RANDOM,
+    MAX_BATCH_RESULTS,
+    DEFAULT_PREFETCH,
+    MAX_PREFETCH,
+)
+from app.forecast import get_forecast, MAX_FORECAST_DAYS
+from app.tag_index import MAX_TAG_SUGGESTIONS
 
 
 def validate_image(stream):
@@ -46,6 +56,22 @@ def validate_image(stream):
     return "." + (format if format != "jpeg" else "jpg")
 
 
+def parse_iso_datetime(value):
+    """Parse an ISO 8601 string as sent by the JS client, e.g. toISOString()
+
+    Returns:
+        [datetime]: naive UTC, as the dates of the database
+    """
+    if value is None:
+        return None
+    if value.endswith("Z"):
+        value = value[:-1]
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
 @bp.route("/upload_image", methods=["POST"])
 def upload_image():
     uploaded_file = request.files["file"]
@@ -125,8 +151,9 @@ def index():
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        buffer = current_app.last_seen_buffer
+        buffer.touch(current_user.id, current_user.last_seen)
+        buffer.maybe_flush()
         g.search_form = SearchForm()
 
 
@@ -147,18 +174,9 @@ def search():
     cards, total = Card.search(
         g.search_form.q.data, page, current_app.config["CARDS_PER_PAGE"]
     )
+    # Cards also match by the names of their tags
     cards = cards.all()
 
-    # Add search by tags
-    tags, _ = Tag.search(
-        g.search_form.q.data, page, current_app.config["CARDS_PER_PAGE"]
-    )
-    for tag in tags:
-        taggings = tag.get_cards()
-        for tagging in taggings:
-            cards.append(Card.query.filter_by(id=tagging.card_id).first())
-            total = total + 1
-
     # Pagination
     next_url = (
         url_for("main.search", q=g.search_form.q.data, page=page + 1)
@@ -255,20 +273,16 @@ def create_card(tag_id):
 @bp.route("/card/<card_id>", methods=["GET", "POST"])
 @login_required
 def card_profile(card_id):
-    card = Card.query.get_or_404(card_id)
-    tags = []
-    for tagging in card.tags.all():
-        tag = Tag.query.filter_by(id=tagging.tag_id).first()
-        if tag:
-            tags.append(tag)
-    return render_template("card_profile.html", card=card, tags=tags)
+    card = Card.query.options(db.selectinload(Card.all_tags)).get_or_404(card_id)
+    return render_template("card_profile.html", card=card, tags=card.all_tags)
 
 
 @bp.route("/card/<card_id>/edit_card", methods=["GET", "POST"])
 @login_required
 def edit_card(card_id):
-    card = Card.query.get_or_404(card_id)
-    tag = card.tags
+    card = Card.query.options(
+        db.joinedload(Card.learn_spaced_rep), db.selectinload(Card.all_tags)
+    ).get_or_404(card_id)
     if current_user.id != card.user_id:
         return redirect(url_for("main.index"))
     form = CardForm()
@@ -324,9 +338,7 @@ def tag_profile(tag_id):
         return redirect(url_for("main.index"))
     edit_tag_form = TagForm()
     page = request.args.get("page", 1, type=int)
-    cards = tag.cards.order_by(Tagging.timestamp.desc()).paginate(
-        page, current_app.config["CARDS_PER_PAGE"], False
-    )
+    cards = tag.card_query().paginate(page, current_app.config["CARDS_PER_PAGE"], False)
     next_url = (
         url_for("main.tag_profile", tag_id=tag.id, page=cards.next_num)
         if cards.has_next
@@ -337,12 +349,11 @@ def tag_profile(tag_id):
         if cards.has_prev
         else None
     )
-
-    ls_cards = [Card.query.filter_by(id=i.card_id).first() for i in cards.items]
     return render_template(
         "tag_profile.html",
         tag=tag,
-        cards=ls_cards,
+        cards=cards.items,
+        card_count=cards.total,
         edit_tag_form=edit_tag_form,
         next_url=next_url,
         prev_url=prev_url,
@@ -363,7 +374,12 @@ def tag():
         db.session.commit()
         flash("Your tag is added!")
         return redirect(url_for("main.tag_profile", tag_id=tag.id))
-    return render_template("tag.html", edit_tag_form=edit_tag_form, user=current_user)
+    return render_template(
+        "tag.html",
+        edit_tag_form=edit_tag_form,
+        tags=current_user.get_tags(),
+        tag_counts=Tag.get_counts(current_user.id),
+    )
 
 
 @bp.route("/tag/edit_tag/<tag_id>", methods=["GET", "POST"])
@@ -390,13 +406,16 @@ def edit_tag(tag_id):
 @login_required
 def delete_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
-    for tagging in tag.cards:
-        card_id = tagging.card_id
-        card = Card.query.get_or_404(card_id)
-        if "<img src=" in card.back and current_app.config["UPLOAD_PATH"] in card.back:
-            Card.delete_card_img(card.back)
-    db.session.delete(tag)
-    db.session.commit()
+    if current_user.id != tag.user_id:
+        return redirect(url_for("main.index"))
+    try:
+        current_user.launch_task("delete_tag", f"Deleting tag {tag.name}...", tag.id)
+        db.session.commit()
+        flash(f"Your tag {tag.name} is being deleted")
+    except RedisError:
+        # No task queue to hand the job over to
+        db.session.rollback()
+        Tag.delete_in_chunks(tag.id)
     if current_user.tags.count() > 0:
         return redirect(url_for("main.tag"))
     else:
@@ -408,6 +427,7 @@ def delete_tag(tag_id):
 def get_cards():
     num_learn = request.args.get("num_learn", type=int)
     tag_names = request.args.get("tag_names", type=str)
+    sampling = request.args.get("sampling", SAMPLING_RANDOM, type=str)
     current_app.logger.info(
         f"uid {current_user.id}: num_learn: {num_learn}, tag_names: {tag_names}"
     )
@@ -420,6 +440,7 @@ def get_cards():
         num_learn=num_learn,
         tag_id=tag_ids,
         user=current_user,
+        sampling=sampling,
     )
     lh.init_session(write_new_session=False)
     cards = [card.to_dict() for card in lh.cards]
@@ -452,7 +473,7 @@ def before_learning():
             f"uid {current_user.id} - card_ids selected to learn: {cards_selected}"
         )
         cards_selected = LearningHelper.parse_cards_from_selected_str(
-            cards_selected_str
+            cards_selected_str, current_user.id
         )
         lsb = LearningSessionBuilder(user=current_user, cards=cards_selected)
         lsb.build()
@@ -464,8 +485,8 @@ def before_learning():
             tag = Tag.query.get(tag_id)
             tag_id = [tag_id]
         lh = LearningHelper(user=current_user, tag_id=tag_id)
-        lh.init_session(write_new_session=False)
-        start_form.num_learn.data = len(lh.cards)
+        lh.init_session(write_new_session=False, count_only=True)
+        start_form.num_learn.data = lh.stats["num_total"]
     return render_template(
         "before_learning.html",
         start_form=start_form,
@@ -495,48 +516,140 @@ def learning():
     )
 
 
+@bp.route("/learning/prefetch", methods=["GET"])
+@login_required
+def learning_prefetch():
+    limit = request.args.get("k", DEFAULT_PREFETCH, type=int)
+    if not 1 <= limit <= MAX_PREFETCH:
+        abort(400)
+    lh = LearningHelper(user=current_user)
+    # Only the cards of a session /learning would still serve
+    status = lh.get_last_session_status()
+    ls_facts = lh.get_pending_lsfs(limit) if status == "still" else []
+    data = []
+    for lsf in ls_facts:
+        card = lsf.card
+        data.append(
+            {
+                "lsf_id": lsf.id,
+                "number": lsf.number,
+                "card": {
+                    "id": card.id,
+                    "front": card.front,
+                    "back": card.back,
+                    "mastery_level": card.learn_spaced_rep.bucket - 1,
+                },
+                "tags": [{"id": tag.id, "name": tag.name} for tag in card.all_tags],
+                "html": render_template(
+                    "_learning_card.html", card=card, tags=card.all_tags
+                ),
+            }
+        )
+    response = {
+        "meta": {
+            "status": "OK",
+            "ls_id": current_user.current_ls_id,
+            "session_status": status,
+        },
+        "data": {"ls_facts": data},
+    }
+    return response
+
+
 @bp.route("/update_lsf_status", methods=["PUT"])
 @login_required
 def update_lsf_status():
     is_ok = request.args.get("is_ok", type=int)
     lsf_id = request.args.get("lsf_id", type=int)
     lsf = LearningSessionFact.query.get(lsf_id)
-    if is_ok:
-        LearningHelper.handle_ok(lsf)
-    else:
-        LearningHelper.handle_fail(lsf)
-    lsf.complete_at = datetime.utcnow()
+    LearningHelper.complete_lsf(lsf, is_ok)
     db.session.add_all([lsf, lsf.card])
     db.session.commit()
     return lsf.to_dict()
 
 
+@bp.route("/update_lsf_status/batch", methods=["PUT"])
+@login_required
+def update_lsf_status_batch():
+    data = request.get_json() or {}
+    if not isinstance(data, dict) or not isinstance(data.get("results", []), list):
+        abort(400)
+    try:
+        results = [
+            {
+                "lsf_id": int(item["lsf_id"]),
+                "is_ok": bool(int(item["is_ok"])),
+                "start_at": parse_iso_datetime(item.get("start_at")),
+                "complete_at": parse_iso_datetime(item.get("complete_at")),
+            }
+            for item in data.get("results", [])
+        ]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        abort(400)
+    if len(results) > MAX_BATCH_RESULTS:
+        abort(400)
+    output = LearningHelper.complete_lsf_batch(current_user, results)
+    for result in output["results"]:
+        if result["next_date"] is not None:
+            result["next_date"] = result["next_date"].isoformat()
+    response = {
+        "meta": {"status": "OK", "not_found": output["not_found"]},
+        "data": {"results": output["results"]},
+    }
+    return response
+
+
 @bp.route("/get_user_tags", methods=["GET"])
 @login_required
 def get_user_tags():
+    prefix = request.args.get("prefix")
+    if prefix is not None:
+        limit = request.args.get("limit", 10, type=int)
+        if not 1 <= limit <= MAX_TAG_SUGGESTIONS:
+            abort(400)
+        names = Tag.get_names_by_prefix(current_user.id, prefix, limit)
+        return {"data": names}
     tags = current_user.tags.order_by(Tag.timestamp.desc()).all()
     names = [tag.name for tag in tags]
     result = {"data": names}
     return result
 
 
+@bp.route("/forecast", methods=["GET"])
+@login_required
+def forecast():
+    days = request.args.get("days", 7, type=int)
+    tag_id = request.args.get("tag_id", type=int)
+    if not 1 <= days <= MAX_FORECAST_DAYS:
+        abort(400)
+    if tag_id is not None:
+        tag = Tag.query.get_or_404(tag_id)
+        if current_user.id != tag.user_id:
+            abort(404)
+    response = {
+        "meta": {"days": days, "tag_id": tag_id},
+        "data": get_forecast(current_user.id, days, tag_id),
+    }
+    return response
+
+
 @bp.route("/stats", methods=["GET"])
 @login_required
 def stats():
-    num_total_cards = len(Card.query.filter_by(user_id=current_user.id).all())
-    num_total_cards_learnt = len(
+    num_total_cards = current_user.get_card_count()
+    num_total_cards_learnt = (
         Card.query.join(
             LearnSpacedRepetition, Card.learn_spaced_rep_id == LearnSpacedRepetition.id
         )
         .filter(Card.user_id == current_user.id, LearnSpacedRepetition.bucket > 1)
-        .all()
+        .count()
     )
-    num_total_cards_mastered = len(
+    num_total_cards_mastered = (
         Card.query.join(
             LearnSpacedRepetition, Card.learn_spaced_rep_id == LearnSpacedRepetition.id
         )
         .filter(Card.user_id == current_user.id, LearnSpacedRepetition.bucket == 6)
-        .all()
+        .count()
     )
 
     last_7_days_ms = datetime.now() - timedelta(days=7)
@@ -611,6 +724,7 @@ def stats():
         last_7_days_wd=last_7_days_wd,
         last_7_days_active_str=last_7_days_active_str,
         streak=streak,
+        tags=current_user.tags.order_by(Tag.name).all(),
     )
 
 
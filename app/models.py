@@ -4,27 +4,45 @@ import json
 import base64
 import os
 import re
+from itertools import chain
+from collections import Counter, defaultdict
 
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app, url_for
 from flask_login import UserMixin, current_user
 from hashlib import md5
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 import jwt
 import redis
 import rq
-import elasticsearch
 
 from app import login
 from app import db
-from app.search import add_to_index, remove_from_index, query_index
+from app import cache
+from app.search_backends import register_search_ddl
+from app.search import bulk_index, get_write_indexes, query_index, BulkIndexError
+
+
+def has_changes(obj, fields):
+    """Whether the flush writes new values of some of the fields of obj"""
+    attrs = db.inspect(obj).attrs
+    return any(
+        field in attrs and attrs[field].history.has_changes() for field in fields
+    )
 
 
 class SearchableMixin(object):
+    # Objects of the flushes queued for indexing, and skipped as none of
+    # their indexed fields changed, in this process
+    index_writes = Counter()
+
     @classmethod
     def search(cls, expression, page, per_page):
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        if not ids:
+            return cls.query.filter_by(id=0), total
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
@@ -36,37 +54,179 @@ class SearchableMixin(object):
         )
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            "add": list(session.new),
-            "update": list(session.dirty),
-            "delete": list(session.deleted),
-        }
+    def before_flush(cls, session, flush_context, instances):
+        """Queue the cards of the renamed and deleted tags, before their
+        taggings are gone"""
+        if not current_app.elasticsearch:
+            return
+        tag_ids = [tag.id for tag in session.deleted if isinstance(tag, Tag)]
+        tag_ids += [
+            tag.id
+            for tag in session.dirty
+            if isinstance(tag, Tag) and has_changes(tag, ["name"])
+        ]
+        if tag_ids:
+            SearchIndexOutbox.add_tagged_cards(session, tag_ids)
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes["add"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["update"]:
+    def after_flush(cls, session, flush_context):
+        """Queue the changed objects in the search index outbox
+
+        The outbox rows are written in the transaction of the change, so that
+        no change is lost if Elasticsearch is down. Card documents hold the
+        names of their tags, a tagged or untagged card is queued as well.
+        The owners of the changed objects get their cached searches dropped
+        once the session commits.
+        """
+        rows = []
+        skipped = 0
+        user_ids = set()
+        tag_ids = set()
+        for obj in chain(session.new, session.dirty, session.deleted):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["delete"]:
-            if isinstance(obj, SearchableMixin):
-                try:
-                    remove_from_index(obj.__tablename__, obj)
-                except elasticsearch.exceptions.NotFoundError:
-                    current_app.logger.warn(f"Not found {obj} to delete.")
-        session._changes = None
+                index, object_id, fields = obj.__tablename__, obj.id, obj.__searchable__
+            elif isinstance(obj, Tagging):
+                index, object_id = Card.__tablename__, obj.card_id
+                fields = ["tag_id", "card_id"]
+            else:
+                continue
+            if obj in session.dirty and not has_changes(obj, fields + ["user_id"]):
+                skipped += 1
+                continue
+            rows.append({"index": index, "object_id": object_id})
+            if isinstance(obj, Tagging):
+                tag_ids.add(obj.tag_id)
+            else:
+                user_ids.add(obj.user_id)
+        if tag_ids:
+            user_ids.update(
+                row.user_id
+                for row in session.connection().execute(
+                    db.select([Tag.user_id]).where(Tag.id.in_(tag_ids))
+                )
+            )
+        user_ids.discard(None)
+        if user_ids:
+            session._search_user_ids = (
+                getattr(session, "_search_user_ids", None) or set()
+            ) | user_ids
+        if not current_app.elasticsearch:
+            return
+        cls.index_writes["skipped"] += skipped
+        if rows:
+            SearchIndexOutbox.add(session, rows)
+            cls.index_writes["sent"] += len(rows)
+
+    @classmethod
+    def after_commit(cls, session):
+        user_ids = getattr(session, "_search_user_ids", None)
+        session._search_user_ids = None
+        if user_ids:
+            cache.bump_generation(user_ids, "search")
+        if getattr(session, "_search_outbox_written", False):
+            session._search_outbox_written = False
+            SearchIndexOutbox.schedule_drain()
+
+    @classmethod
+    def after_rollback(cls, session):
+        session._search_user_ids = None
+        session._search_outbox_written = False
+
+    @staticmethod
+    def get_model(index):
+        return next(
+            model
+            for model in SearchableMixin.__subclasses__()
+            if model.__tablename__ == index
+        )
+
+    @classmethod
+    def get_document_columns(cls):
+        """Columns of the search document, the searchable fields and the owner"""
+        table = cls.__table__
+        columns = [table.c[field] for field in cls.__searchable__]
+        if "user_id" in table.c:
+            columns.append(table.c.user_id)
+        return columns
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def to_documents(cls, rows):
+        """Search documents of rows of the id and the document columns
+
+        Returns:
+            [dict]: documents by id, in the order of the rows
+        """
+        columns = cls.get_document_columns()
+        return {
+            row.id: {column.key: row[column.key] for column in columns} for row in rows
+        }
 
+    @classmethod
+    def get_mapping(cls):
+        """Explicit Elasticsearch mapping of the search document"""
+        return {
+            "dynamic": "strict",
+            "properties": {
+                column.key: {
+                    "type": "integer" if isinstance(column.type, db.Integer) else "text"
+                }
+                for column in cls.get_document_columns()
+            },
+        }
 
-db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
+    @classmethod
+    def reindex(
+        cls, start_id=0, end_id=None, chunk_size=1000, on_chunk=None, target=None
+    ):
+        """Index the objects with start_id < id <= end_id with bulk requests
+
+        Rows are read in id order by keyset chunks of the document columns
+        only, one bulk request per chunk.
+
+        Args:
+            on_chunk (callable): called with the last id indexed and the
+                number of objects indexed so far, after every chunk
+            target (str): new version of the index being loaded, where the
+                documents written meanwhile by the outbox drain, which are
+                newer, are kept
+
+        Returns:
+            [int]: number of objects indexed
+        """
+        table = cls.__table__
+        columns = cls.get_document_columns()
+        last_id = start_id
+        count = 0
+        while True:
+            query = (
+                db.select([table.c.id] + columns)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(chunk_size)
+            )
+            if end_id is not None:
+                query = query.where(table.c.id <= end_id)
+            rows = db.session.execute(query).fetchall()
+            if not rows:
+                break
+            failed = bulk_index(
+                target or cls.__tablename__,
+                list(cls.to_documents(rows).items()),
+                op_type="create" if target else "index",
+            )
+            if failed:
+                raise BulkIndexError(failed)
+            last_id = rows[-1].id
+            count += len(rows)
+            if on_chunk:
+                on_chunk(last_id, count)
+        return count
+
+
+db.event.listen(db.session, "before_flush", SearchableMixin.before_flush)
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(db.session, "after_rollback", SearchableMixin.after_rollback)
 
 
 class PaginatedAPIMixin(object):
@@ -96,7 +256,7 @@ class PaginatedAPIMixin(object):
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return User.get_cached(int(id))
 
 
 class User(UserMixin, db.Model):
@@ -125,13 +285,29 @@ class User(UserMixin, db.Model):
         lazy="dynamic",
         cascade="all, delete-orphan",
     )
+    learning_sessions = db.relationship(
+        "LearningSession",
+        backref="user",
+        lazy="dynamic",
+        cascade="all, delete-orphan",
+    )
     current_ls_id = db.Column(db.Integer)
+    ls_state = db.relationship(
+        "LearningSessionState",
+        backref="user",
+        uselist=False,
+        cascade="all, delete-orphan",
+    )
+    user_stats = db.relationship(
+        "UserStats", backref="user", uselist=False, cascade="all, delete-orphan"
+    )
 
     def __repr__(self):
         return "<User {}>".format(self.username)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
+        current_app.identity_cache.invalidate([self.id])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -181,13 +357,27 @@ class User(UserMixin, db.Model):
         tags = self.tags.order_by(Tag.timestamp.desc()).all()
         return tags
 
+    def get_card_count(self):
+        if self.user_stats is None:
+            return self.cards.count()
+        return self.user_stats.card_count
+
+    def get_tag_count(self):
+        if self.user_stats is None:
+            return self.tags.count()
+        return self.user_stats.tag_count
+
+    def get_last_seen(self):
+        """last_seen, including the activity not written to the database yet"""
+        return current_app.last_seen_buffer.get(self.id) or self.last_seen
+
     def to_dict(self, include_email=False):
         data = {
             "id": self.id,
             "username": self.username,
-            "last_seen": self.last_seen.isoformat() + "Z",
-            "card_count": self.cards.count(),
-            "tag_count": self.tags.count(),
+            "last_seen": self.get_last_seen().isoformat() + "Z",
+            "card_count": self.get_card_count(),
+            "tag_count": self.get_tag_count(),
             "_links": {"self": url_for("api.get_user", id=self.id)},
         }
         if include_email:
@@ -209,21 +399,81 @@ class User(UserMixin, db.Model):
         self.token = base64.b64encode(os.urandom(24)).decode("utf-8")
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
+        current_app.identity_cache.invalidate([self.id])
         return self.token
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        current_app.identity_cache.invalidate([self.id])
 
     @staticmethod
     def check_token(token):
-        user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        identities = current_app.identity_cache
+        user_id = identities.get_token_user_id(token)
+        user = User.get_cached(user_id) if user_id is not None else None
+        if user is None or user.token != token:
+            user = User.query.filter_by(token=token).first()
+            if user is None:
+                return None
+            # The user is snapshot by the next get_cached, which reads the
+            # generation before the user
+            identities.set_token(token, user.id)
+        if user.token_expiration < datetime.utcnow():
             return None
         return user
 
+    def cache_identity(self, generation: int):
+        """Snapshot the columns of the user in the identity cache
+
+        Args:
+            generation (int): identity generation of the user, read before the
+                user was loaded
+
+        Users with changes which are not flushed yet are never cached.
+        """
+        state = db.inspect(self)
+        if state.modified or state.pending or state.transient:
+            return
+        snapshot = {
+            column.key: getattr(self, column.key) for column in User.__table__.columns
+        }
+        current_app.identity_cache.set_user(self.id, snapshot, generation)
+
+    @staticmethod
+    def get_cached(user_id: int):
+        """User by id, without a query when it is in the identity cache
+
+        A snapshot is only used at the identity generation of the user it was
+        taken at, every commit writing the user bumps it, and never while
+        Redis is unavailable, as the other processes could not drop it then.
+        The cached user is
+        merged into the session without being loaded, its relationships are
+        loaded lazily as usual.
+        """
+        user = db.session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            return user
+        generation = cache.get_generation(user_id, "identity")
+        snapshot = None
+        if generation is not None:
+            snapshot = current_app.identity_cache.get_user(user_id, generation)
+        if snapshot is None:
+            user = User.query.get(user_id)
+            if user is not None and generation is not None:
+                user.cache_identity(generation)
+            return user
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def set_current_ls_id(self, current_ls_id: int):
         self.current_ls_id = current_ls_id
 
+    def get_current_session(self):
+        if self.current_ls_id is None:
+            return None
+        return LearningSession.query.get(self.current_ls_id)
+
     def get_latest_card(self):
         return self.cards.order_by(Card.timestamp.desc()).first()
 
@@ -262,13 +512,135 @@ class Tag(PaginatedAPIMixin, SearchableMixin, db.Model):
     def get_cards(self):
         return self.cards.filter_by(tag_id=Tag.id).all()
 
+    @staticmethod
+    def get_counts(user_id):
+        """Count the cards, due today and mastered cards of every tag of a user
+
+        One grouped query for all the tags, cached until the user's cards change.
+
+        Returns:
+            [dict]: {"card_count", "due_today", "mastered"} by tag id
+        """
+        learn_date = datetime.today().replace(hour=23, minute=59, second=59)
+        key = cache.user_key(user_id, "tag_counts", learn_date.date().isoformat())
+        counts = cache.get(key)
+        if counts is None:
+            lsr = LearnSpacedRepetition
+            max_bucket = lsr.get_max_bucket()
+            is_due = db.and_(lsr.next_date <= learn_date, lsr.bucket < max_bucket)
+            rows = (
+                db.session.query(
+                    Tagging.tag_id,
+                    db.func.count(Card.id),
+                    db.func.sum(db.case([(is_due, 1)], else_=0)),
+                    db.func.sum(db.case([(lsr.bucket >= max_bucket, 1)], else_=0)),
+                )
+                .join(Card, Tagging.card_id == Card.id)
+                .outerjoin(lsr, Card.learn_spaced_rep_id == lsr.id)
+                .filter(Card.user_id == user_id)
+                .group_by(Tagging.tag_id)
+            )
+            counts = {
+                str(tag_id): {
+                    "card_count": card_count,
+                    "due_today": int(due_today or 0),
+                    "mastered": int(mastered or 0),
+                }
+                for tag_id, card_count, due_today, mastered in rows
+            }
+            cache.set(key, counts)
+        empty = {"card_count": 0, "due_today": 0, "mastered": 0}
+        return defaultdict(lambda: empty, {int(k): v for k, v in counts.items()})
+
+    @staticmethod
+    def delete_in_chunks(tag_id, chunk_size=500, set_progress=None):
+        """Delete a tag and its taggings
+
+        Taggings are deleted with bulk statements, one chunk of cards and one
+        commit at a time, so that a large tag never holds a long transaction.
+        The cards themselves are kept, and so are their images.
+
+        Args:
+            tag_id (int): tag to delete
+            chunk_size (int, optional): number of cards per chunk
+            set_progress (callable, optional): called with the progress, 0-100
+        """
+        tag = Tag.query.get(tag_id)
+        if tag is None:
+            return
+        table = Tagging.__table__
+        total = tag.cards.count()
+        num_done = 0
+        last_card_id = 0
+        while True:
+            card_ids = [
+                row.card_id
+                for row in db.session.execute(
+                    db.select([table.c.card_id])
+                    .where(table.c.tag_id == tag_id)
+                    .where(table.c.card_id > last_card_id)
+                    .order_by(table.c.card_id)
+                    .limit(chunk_size)
+                )
+            ]
+            if not card_ids:
+                break
+            last_card_id = card_ids[-1]
+            db.session.execute(
+                table.delete()
+                .where(table.c.tag_id == tag_id)
+                .where(table.c.card_id.in_(card_ids))
+            )
+            # Bulk statements skip the session listeners
+            if current_app.elasticsearch:
+                SearchIndexOutbox.add(
+                    db.session(),
+                    [
+                        {"index": Card.__tablename__, "object_id": card_id}
+                        for card_id in card_ids
+                    ],
+                )
+            db.session.commit()
+            num_done += len(card_ids)
+            if set_progress is not None and total > 0:
+                set_progress(min(99, 100 * num_done // total))
+        # Through the session, for the search index and the user counters
+        db.session.delete(tag)
+        db.session.commit()
+
+    @staticmethod
+    def get_names_by_prefix(user_id, prefix, limit):
+        """Tag names of a user starting with prefix, from the tag prefix index
+
+        The names are read from the database only when the index of the user
+        is not cached, or stale.
+        """
+        tag_index = current_app.tag_index
+        generation = cache.get_generation(user_id, "tags")
+        value = tag_index.get(user_id, generation)
+        if value is None:
+            rows = db.session.query(Tag.name).filter(Tag.user_id == user_id)
+            value = tag_index.set(user_id, generation, [name for name, in rows])
+        return tag_index.search(value, prefix, limit)
+
+    def card_query(self):
+        """Query the cards of the tag, last tagged first, with their schedule"""
+        return (
+            Card.query.join(Tagging, Tagging.card_id == Card.id)
+            .filter(Tagging.tag_id == self.id, Card.user_id == self.user_id)
+            .options(db.joinedload(Card.learn_spaced_rep))
+            .order_by(Tagging.timestamp.desc(), Card.id.desc())
+        )
+
     def to_dict(self):
         data = {
             "id": self.id,
             "name": self.name,
             "timestamp": self.timestamp.isoformat() + "Z",
             "user_id": self.user_id,
-            "card_ids": [card.id for card in self.get_cards()],
+            "card_ids": [
+                tagging.card_id for tagging in self.cards.order_by(Tagging.card_id)
+            ],
             "_links": {"self": url_for("api.get_tag", id=self.id)},
         }
         return data
@@ -298,6 +670,11 @@ class Card(PaginatedAPIMixin, SearchableMixin, db.Model):
     learn_spaced_rep_id = db.Column(
         db.Integer, db.ForeignKey("learn_spaced_repetition.id")
     )
+    # Read-only shortcut through Tagging, to be loaded with selectinload when
+    # the tags of many cards are displayed
+    all_tags = db.relationship(
+        "Tag", secondary="tagging", viewonly=True, order_by="Tag.id"
+    )
     ls_facts = db.relationship(
         "LearningSessionFact",
         backref="card",
@@ -305,20 +682,54 @@ class Card(PaginatedAPIMixin, SearchableMixin, db.Model):
         cascade="all, delete-orphan",
     )
 
+    @classmethod
+    def get_owned_by_ids(cls, card_ids, user_id):
+        """Load the cards of a user from a list of ids with a single query
+
+        Ids of missing cards and of cards of other users are skipped, duplicates
+        are kept once. Cards come in the order of `card_ids` with their
+        learn_spaced_rep already loaded.
+        """
+        card_ids = list(dict.fromkeys(int(card_id) for card_id in card_ids))
+        if not card_ids:
+            return []
+        cards = (
+            cls.query.filter(cls.id.in_(card_ids))
+            .filter(cls.user_id == user_id)
+            .options(db.joinedload(cls.learn_spaced_rep))
+            .all()
+        )
+        cards_by_id = {card.id: card for card in cards}
+        return [cards_by_id[card_id] for card_id in card_ids if card_id in cards_by_id]
+
+    @classmethod
+    def to_documents(cls, rows):
+        """Search documents with the names of the tags, so that a single
+        search matches the cards by their text and by their tags"""
+        documents = super().to_documents(rows)
+        for document in documents.values():
+            document["tags"] = []
+        if documents:
+            for card_id, name in db.session.execute(
+                db.select([Tagging.card_id, Tag.name])
+                .select_from(Tagging.__table__.join(Tag.__table__))
+                .where(Tagging.card_id.in_(list(documents)))
+                .order_by(Tagging.card_id, Tag.id)
+            ):
+                documents[card_id]["tags"].append(name)
+        return documents
+
+    @classmethod
+    def get_mapping(cls):
+        mapping = super().get_mapping()
+        mapping["properties"]["tags"] = {"type": "text"}
+        return mapping
+
     def get_tag_names(self):
-        taggings = self.tags.filter_by(card_id=Card.id).all()
-        tag_names = []
-        for tagging in taggings:
-            tag_name = Tag.query.get_or_404(tagging.tag_id).name
-            tag_names.append(tag_name)
-        return tag_names
+        return [tag.name for tag in self.all_tags]
 
     def get_all_tags(self):
-        taggings = self.tags.filter_by(card_id=Card.id).all()
-        tags = []
-        for tagging in taggings:
-            tags.append(Tag.query.get(tagging.tag_id))
-        return tags
+        return self.all_tags
 
     def preview_back(self):
         if len(self.back) > self.MAX_CHAR_BACK:
@@ -370,17 +781,24 @@ class Card(PaginatedAPIMixin, SearchableMixin, db.Model):
                 setattr(self.learn_spaced_rep, field, data[field])
         setattr(self, "timestamp", datetime.utcnow())
 
+    IMG_SRC = re.compile("""src=[\"\'](.+?)[\"\']""")
+
+    @staticmethod
+    def get_img_paths(back: str):
+        """List the paths of the uploaded images shown in a card back"""
+        if "<img src=" not in back or current_app.config["UPLOAD_PATH"] not in back:
+            return []
+        paths = []
+        for link in Card.IMG_SRC.finditer(back):
+            filename = link.group(1).split("/")[-1]
+            paths.append(
+                os.path.join("app", current_app.config["UPLOAD_PATH"], filename)
+            )
+        return paths
+
     @staticmethod
     def delete_card_img(back: str):
-        # Locate
-        link = re.compile("""src=[\"\'](.+?)[\"\']""")
-
-        links = link.finditer(back)
-        for link in links:
-            full_path = link.group(1)
-            filename = full_path.split("/")[-1]
-            filepath = os.path.join("app", current_app.config["UPLOAD_PATH"], filename)
-            # Delete
+        for filepath in Card.get_img_paths(back):
             os.remove(filepath)
 
 
@@ -395,6 +813,173 @@ class Notification(db.Model):
         return json.loads(str(self.payload_json))
 
 
+class SearchIndexOutbox(db.Model):
+    """Objects to send to the search index, drained by a background job
+
+    Rows only hold the index and id of an object. The drain reads the object
+    when it runs, so several changes of an object make one bulk action, and
+    an object which is gone is deleted from the index.
+    """
+
+    # Seconds to wait before each retry of a failed drain
+    RETRY_INTERVALS = [10, 30, 60, 120, 300]
+    MAX_ATTEMPTS = len(RETRY_INTERVALS)
+    SCHEDULED_KEY = "search_outbox:scheduled"
+    LOCK_KEY = "search_outbox:drain"
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+
+    @classmethod
+    def schedule_drain(cls):
+        """Enqueue a drain, unless one is already waiting to start"""
+        try:
+            if current_app.redis.set(cls.SCHEDULED_KEY, 1, nx=True, ex=60):
+                current_app.task_queue.enqueue(
+                    "app.tasks.drain_search_outbox",
+                    retry=rq.Retry(max=cls.MAX_ATTEMPTS, interval=cls.RETRY_INTERVALS),
+                )
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f"Search index drain not scheduled: {e}")
+
+    @classmethod
+    def add(cls, session, rows):
+        """Queue objects, the drain is scheduled once the session commits
+
+        Args:
+            rows (list): dicts of the index and the object_id
+        """
+        session.connection().execute(cls.__table__.insert(), rows)
+        session._search_outbox_written = True
+
+    @classmethod
+    def add_tagged_cards(cls, session, tag_ids):
+        """Queue the cards of tags, in a single INSERT ... SELECT"""
+        tagging = Tagging.__table__
+        session.connection().execute(
+            cls.__table__.insert().from_select(
+                ["index", "object_id", "created_at", "attempts"],
+                db.select(
+                    [
+                        db.literal(Card.__tablename__),
+                        tagging.c.card_id,
+                        db.literal(datetime.utcnow()),
+                        db.literal(0),
+                    ]
+                ).where(tagging.c.tag_id.in_(tag_ids)),
+            )
+        )
+        session._search_outbox_written = True
+
+    @classmethod
+    def requeue(cls, index=None):
+        """Retry the rows the drain gave up on, e.g. once the index is fixed
+
+        Returns:
+            [int]: number of rows requeued
+        """
+        query = cls.query.filter(cls.attempts >= cls.MAX_ATTEMPTS)
+        if index is not None:
+            query = query.filter_by(index=index)
+        count = query.update({cls.attempts: 0}, synchronize_session=False)
+        db.session.commit()
+        if count:
+            cls.schedule_drain()
+        return count
+
+    @staticmethod
+    def _get_documents(index, object_ids):
+        model = SearchableMixin.get_model(index)
+        table = model.__table__
+        rows = db.session.execute(
+            db.select([table.c.id] + model.get_document_columns()).where(
+                table.c.id.in_(object_ids)
+            )
+        )
+        return model.to_documents(rows)
+
+    @classmethod
+    def drain(cls, batch_size=500):
+        """Send the queued changes to Elasticsearch with bulk requests
+
+        Returns:
+            [Tuple[int, int]]: numbers of documents sent and of failed rows,
+                failed rows are retried until MAX_ATTEMPTS, then logged and
+                left to requeue
+        """
+        sent = failed = 0
+        while True:
+            rows = (
+                cls.query.filter(cls.attempts < cls.MAX_ATTEMPTS)
+                .order_by(cls.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            row_ids = defaultdict(list)
+            for row in rows:
+                row_ids[(row.index, row.object_id)].append(row.id)
+            object_ids = defaultdict(list)
+            for index, object_id in row_ids:
+                object_ids[index].append(object_id)
+            keys, body = [], []
+            user_ids = set()
+            for index, ids in object_ids.items():
+                documents = cls._get_documents(index, ids)
+                user_ids.update(
+                    document.get("user_id") for document in documents.values()
+                )
+                # Several indexes while a new version of the index is loaded
+                for name in get_write_indexes(index):
+                    for object_id in ids:
+                        keys.append((index, object_id))
+                        meta = {"_index": name, "_id": object_id}
+                        if object_id in documents:
+                            body.append({"index": meta})
+                            body.append(documents[object_id])
+                        else:
+                            body.append({"delete": meta})
+            response = current_app.elasticsearch.bulk(body=body)
+            errors = set()
+            # Bulk items come in the order of the actions
+            for key, item in zip(keys, response["items"]):
+                ((action, result),) = item.items()
+                if result["status"] >= 300 and not (
+                    action == "delete" and result["status"] == 404
+                ):
+                    current_app.logger.error(f"Search index {action} failed: {result}")
+                    errors.add(key)
+            done = [i for key, ids in row_ids.items() if key not in errors for i in ids]
+            retry = [i for key, ids in row_ids.items() if key in errors for i in ids]
+            cls.query.filter(cls.id.in_(done)).delete(synchronize_session=False)
+            if retry:
+                cls.query.filter(cls.id.in_(retry)).update(
+                    {cls.attempts: cls.attempts + 1}, synchronize_session=False
+                )
+                given_up = (
+                    cls.query.filter(cls.id.in_(retry))
+                    .filter(cls.attempts >= cls.MAX_ATTEMPTS)
+                    .all()
+                )
+                for row in given_up:
+                    current_app.logger.error(
+                        f"Search index outbox gave up on {row.index} {row.object_id}"
+                        f" after {row.attempts} attempts, see requeue"
+                    )
+            db.session.commit()
+            # Searches cached before the changes were indexed are stale
+            user_ids.discard(None)
+            cache.bump_generation(user_ids, "search")
+            sent += len(row_ids) - len(errors)
+            failed += len(retry)
+            if errors:
+                break
+        return sent, failed
+
+
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     name = db.Column(db.String(128), index=True)
@@ -414,12 +999,27 @@ class Task(db.Model):
         return job.meta.get("progress", 0) if job is not None else 100
 
 
+class LearningSession(db.Model):
+    # The primary key is the ls_id shared by all the LearningSessionFact of a
+    # session, so that ids are allocated atomically by the database
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    ls_facts = db.relationship(
+        "LearningSessionFact",
+        backref="learning_session",
+        lazy="dynamic",
+        cascade="all, delete-orphan",
+    )
+
+
 class LearningSessionFact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    # ls_id to be manually defined as auto-incremented in batch
-    # For example, current model have max(ls_id) = 10 then the next 5 cards of a
-    # new learning session will all have ls_id = 11
-    ls_id = db.Column(db.Integer, nullable=False, index=True)
+    ls_id = db.Column(
+        db.Integer, db.ForeignKey("learning_session.id"), nullable=False, index=True
+    )
     user_id = db.Column(
         db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
     )
@@ -447,6 +1047,182 @@ class LearningSessionFact(db.Model):
         return data
 
 
+class LearningSessionState(db.Model):
+    """Compact per-user summary of the current learning session
+
+    Kept in sync incrementally while the session is built and answered, so that
+    resolving the session status is a single keyed read instead of several
+    scans over LearningSessionFact.
+    """
+
+    STATUS_STILL = "still"
+    STATUS_OUTDATED = "outdated"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    ls_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_STILL)
+    created_at = db.Column(db.DateTime)
+    last_complete_at = db.Column(db.DateTime)
+    num_remaining = db.Column(db.Integer, nullable=False, default=0)
+
+    def is_complete(self):
+        return self.num_remaining <= 0
+
+    def reset(self, ls_id: int, created_at: datetime, num_remaining: int):
+        self.ls_id = ls_id
+        self.status = self.STATUS_STILL
+        self.created_at = created_at
+        self.last_complete_at = None
+        self.num_remaining = num_remaining
+
+    def record_complete(self, complete_at: datetime, num_complete: int = 1):
+        # Decrement in SQL so that concurrent answers do not lose updates
+        self.num_remaining = LearningSessionState.num_remaining - num_complete
+        self.last_complete_at = complete_at
+
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        """Mark sessions outdated when their owner adds or edits a card"""
+        user_ids = set()
+        for obj in session.new:
+            if isinstance(obj, Card) and obj.user_id is not None:
+                user_ids.add(obj.user_id)
+        for obj in session.dirty:
+            if (
+                isinstance(obj, Card)
+                and db.inspect(obj).attrs.timestamp.history.has_changes()
+            ):
+                user_ids.add(obj.user_id)
+        if not user_ids:
+            return
+        session.connection().execute(
+            cls.__table__.update()
+            .where(cls.user_id.in_(user_ids))
+            .where(cls.status == cls.STATUS_STILL)
+            .values(status=cls.STATUS_OUTDATED)
+        )
+
+
+db.event.listen(db.session, "before_flush", LearningSessionState.before_flush)
+
+
+class UserStats(db.Model):
+    """Card and tag counts of a user
+
+    Kept up to date in the same flush as the cards and tags which are created
+    or deleted, so that reading them never scans the card table.
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    card_count = db.Column(db.Integer, nullable=False, default=0)
+    tag_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def _count_query(model, user_id):
+        """Scalar subquery counting the rows of `model` owned by `user_id`"""
+        return db.select([db.func.count()]).where(model.user_id == user_id).as_scalar()
+
+    @classmethod
+    def add(cls, connection, user_id: int, card_delta: int = 0, tag_delta: int = 0):
+        """Apply count changes of a user, to be called inside its transaction
+
+        The counts are recomputed when the user has no row yet. The row is
+        inserted unless another transaction inserted it meanwhile, then the
+        changes are applied to that row.
+        """
+        table = cls.__table__
+        update = (
+            table.update()
+            .where(table.c.user_id == user_id)
+            .values(
+                card_count=table.c.card_count + card_delta,
+                tag_count=table.c.tag_count + tag_delta,
+            )
+        )
+        if connection.execute(update).rowcount > 0:
+            return
+        dialect = connection.dialect.name
+        if dialect == "postgresql":
+            insert = postgresql.insert(table).on_conflict_do_nothing()
+        elif dialect == "sqlite":
+            insert = table.insert().prefix_with("OR IGNORE")
+        else:
+            insert = table.insert()
+        result = connection.execute(
+            insert.values(
+                user_id=user_id,
+                card_count=cls._count_query(Card, user_id),
+                tag_count=cls._count_query(Tag, user_id),
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(update)
+
+    @classmethod
+    def repair(cls) -> int:
+        """Recompute the counts of every user in bulk
+
+        Returns:
+            [int]: number of users whose counts were wrong or missing
+        """
+        table = cls.__table__
+        card_count = cls._count_query(Card, table.c.user_id)
+        tag_count = cls._count_query(Tag, table.c.user_id)
+        result = db.session.execute(
+            table.update()
+            .where(
+                db.or_(table.c.card_count != card_count, table.c.tag_count != tag_count)
+            )
+            .values(card_count=card_count, tag_count=tag_count)
+        )
+        num_repaired = result.rowcount
+        missing = db.select(
+            [
+                User.id,
+                cls._count_query(Card, User.id),
+                cls._count_query(Tag, User.id),
+            ]
+        ).where(~db.exists().where(table.c.user_id == User.id))
+        result = db.session.execute(
+            table.insert().from_select(["user_id", "card_count", "tag_count"], missing)
+        )
+        num_repaired += result.rowcount
+        db.session.commit()
+        return num_repaired
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        deltas = defaultdict(lambda: [0, 0])
+        new_user_ids = set()
+        deleted_user_ids = set()
+        for obj in session.new:
+            if isinstance(obj, User):
+                new_user_ids.add(obj.id)
+            elif isinstance(obj, Card):
+                deltas[obj.user_id][0] += 1
+            elif isinstance(obj, Tag):
+                deltas[obj.user_id][1] += 1
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                deleted_user_ids.add(obj.id)
+            elif isinstance(obj, Card):
+                deltas[obj.user_id][0] -= 1
+            elif isinstance(obj, Tag):
+                deltas[obj.user_id][1] -= 1
+        if not new_user_ids and not deltas:
+            return
+        connection = session.connection()
+        for user_id in new_user_ids:
+            connection.execute(cls.__table__.insert().values(user_id=user_id))
+        for user_id, (card_delta, tag_delta) in deltas.items():
+            if user_id is None or user_id in deleted_user_ids:
+                continue
+            if card_delta != 0 or tag_delta != 0:
+                cls.add(connection, user_id, card_delta, tag_delta)
+
+
+db.event.listen(db.session, "after_flush", UserStats.after_flush)
+
+
 class LearnSpacedRepetition(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     next_date = db.Column(db.DateTime, default=datetime.utcnow().date, index=True)
@@ -454,6 +1230,10 @@ class LearnSpacedRepetition(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     card = db.relationship("Card", backref="learn_spaced_rep", lazy="dynamic")
 
+    # Days until the next learning date, indexed by bucket. Cards in the max
+    # bucket are mastered and have no next learning date.
+    INTERVAL_DAYS = (0, 1, 1, 1, 2, 2)
+
     @staticmethod
     def get_max_bucket():
         return 6
@@ -462,7 +1242,126 @@ class LearnSpacedRepetition(db.Model):
     def _get_day_from_bucket(bucket):
         if bucket <= 0:
             return 0
-        elif bucket <= 3:
-            return 1
-        elif bucket <= 5:
-            return 2
+        elif bucket < len(LearnSpacedRepetition.INTERVAL_DAYS):
+            return LearnSpacedRepetition.INTERVAL_DAYS[bucket]
+
+
+class UserCache(object):
+    """Invalidate the cached values of the users whose learning data changed"""
+
+    @staticmethod
+    def _get_user_ids(session, objs):
+        user_ids = set()
+        tag_ids = set()
+        lsr_ids = set()
+        for obj in objs:
+            if isinstance(obj, (Card, Tag, LearningSessionFact)):
+                user_ids.add(obj.user_id)
+            elif isinstance(obj, Tagging):
+                tag_ids.add(obj.tag_id)
+            elif isinstance(obj, LearnSpacedRepetition):
+                lsr_ids.add(obj.id)
+        connection = session.connection()
+        if tag_ids:
+            rows = connection.execute(
+                db.select([Tag.user_id]).where(Tag.id.in_(tag_ids))
+            )
+            user_ids.update(row.user_id for row in rows)
+        if lsr_ids:
+            rows = connection.execute(
+                db.select([Card.user_id]).where(Card.learn_spaced_rep_id.in_(lsr_ids))
+            )
+            user_ids.update(row.user_id for row in rows)
+        user_ids.discard(None)
+        return user_ids
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        user_ids = cls._get_user_ids(
+            session, chain(session.new, session.dirty, session.deleted)
+        )
+        session._cache_user_ids = (
+            getattr(session, "_cache_user_ids", None) or set()
+        ) | user_ids
+
+    @classmethod
+    def after_commit(cls, session):
+        user_ids = getattr(session, "_cache_user_ids", None)
+        session._cache_user_ids = None
+        if user_ids:
+            cache.bump_generation(user_ids)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session._cache_user_ids = None
+
+
+class IdentityCacheListener(object):
+    """Drop the users written by a transaction from the identity cache"""
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        user_ids = {
+            obj.id
+            for obj in chain(session.new, session.dirty, session.deleted)
+            if isinstance(obj, User)
+        }
+        session._identity_user_ids = (
+            getattr(session, "_identity_user_ids", None) or set()
+        ) | user_ids
+
+    @staticmethod
+    def after_commit(session):
+        user_ids = getattr(session, "_identity_user_ids", None)
+        session._identity_user_ids = None
+        if user_ids:
+            current_app.identity_cache.invalidate(user_ids)
+            cache.bump_generation(user_ids, "identity")
+
+    @staticmethod
+    def after_rollback(session):
+        session._identity_user_ids = None
+
+
+class TagIndexListener(object):
+    """Drop the users whose tags a transaction creates, renames or deletes
+    from the tag prefix index, in every process through their "tags"
+    generation"""
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        user_ids = {
+            obj.user_id
+            for obj in chain(session.new, session.dirty, session.deleted)
+            if isinstance(obj, Tag)
+            and (obj not in session.dirty or has_changes(obj, ["name", "user_id"]))
+        }
+        session._tag_index_user_ids = (
+            getattr(session, "_tag_index_user_ids", None) or set()
+        ) | user_ids
+
+    @staticmethod
+    def after_commit(session):
+        user_ids = getattr(session, "_tag_index_user_ids", None)
+        session._tag_index_user_ids = None
+        if user_ids:
+            current_app.tag_index.invalidate(user_ids)
+            cache.bump_generation(user_ids, "tags")
+
+    @staticmethod
+    def after_rollback(session):
+        session._tag_index_user_ids = None
+
+
+for model in (Card, Tag):
+    register_search_ddl(model.__table__, model.__searchable__)
+
+db.event.listen(db.session, "after_flush", UserCache.after_flush)
+db.event.listen(db.session, "after_commit", UserCache.after_commit)
+db.event.listen(db.session, "after_rollback", UserCache.after_rollback)
+db.event.listen(db.session, "after_flush", IdentityCacheListener.after_flush)
+db.event.listen(db.session, "after_commit", IdentityCacheListener.after_commit)
+db.event.listen(db.session, "after_rollback", IdentityCacheListener.after_rollback)
+db.event.listen(db.session, "after_flush", TagIndexListener.after_flush)
+db.event.listen(db.session, "after_commit", TagIndexListener.after_commit)
+db.event.listen(db.session, "after_rollback", TagIndexListener.after_rollback)
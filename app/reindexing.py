@@ -0,0 +1,225 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy import func
+
+from app import create_app, db
+from app.models import SearchableMixin
+from app.search import create_index_version, swap_index_version
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class ReindexCheckpoint:
+    """Progress of a reindex, kept in JSON files of a directory
+
+    The id ranges of an index are saved when the reindex starts, so that a
+    resumed run splits the work the same way, and every range saves the last
+    id it indexed after each chunk. A rebuild also saves the new version of
+    every index, and clears the checkpoint once it is served.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _read(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def _write(self, name, value):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.directory, name))
+
+    def get_target(self, index: str) -> Optional[str]:
+        return self._read(f"{index}.target.json", None)
+
+    def set_target(self, index: str, target: str):
+        self._write(f"{index}.target.json", target)
+
+    def get_ranges(self, index: str) -> Optional[List[list]]:
+        return self._read(f"{index}.json", None)
+
+    def set_ranges(self, index: str, ranges: List[Tuple[int, Optional[int]]]):
+        self._write(f"{index}.json", ranges)
+
+    def get_last_id(self, index: str, part: int, default: int) -> int:
+        return self._read(f"{index}.{part}.json", default)
+
+    def set_last_id(self, index: str, part: int, last_id: int):
+        self._write(f"{index}.{part}.json", last_id)
+
+    def saver(self, index: str, part: int):
+        """on_chunk callback of SearchableMixin.reindex saving the last id"""
+        return lambda last_id, count: self.set_last_id(index, part, last_id)
+
+
+def get_id_ranges(model, parts: int) -> List[Tuple[int, Optional[int]]]:
+    """Split the ids of a model into ranges of about the same size
+
+    Ranges are (start_id, end_id) with start_id < id <= end_id. The last one
+    has no end, so that it also covers the objects created meanwhile.
+    """
+    low, high = db.session.query(func.min(model.id), func.max(model.id)).one()
+    if low is None:
+        return [(0, None)]
+    size = -(-(high - low + 1) // parts)
+    ranges = [(start - 1, start - 1 + size) for start in range(low, high + 1, size)]
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def reindex_part(
+    index: str,
+    part: int,
+    start_id: int,
+    end_id: Optional[int],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    checkpoint_dir: str = None,
+    target: str = None,
+) -> int:
+    """Reindex one id range, from its checkpoint if any
+
+    Returns:
+        [int]: number of objects indexed by this run
+    """
+    model = SearchableMixin.get_model(index)
+    on_chunk = None
+    if checkpoint_dir:
+        checkpoint = ReindexCheckpoint(checkpoint_dir)
+        start_id = checkpoint.get_last_id(index, part, start_id)
+        on_chunk = checkpoint.saver(index, part)
+    count = model.reindex(start_id, end_id, chunk_size, on_chunk, target)
+    current_app.logger.info(f"Reindexed {count} {index} of part {part}")
+    return count
+
+
+def _init_worker(config_name):
+    app = create_app(config_name)
+    app.app_context().push()
+
+
+def reindex(
+    indexes: List[str],
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    checkpoint_dir: str = None,
+    config_name: str = "default",
+    targets: dict = None,
+) -> dict:
+    """Reindex whole tables, each one split into `workers` id ranges
+
+    With several workers the ranges run in parallel processes, each with its
+    own application, database connections and Elasticsearch client.
+
+    Args:
+        targets (dict): new version of the index to load, by index. Without
+            it the documents are written to the live indexes.
+
+    Returns:
+        [dict]: number of objects indexed by index
+    """
+    targets = targets or {}
+    checkpoint = ReindexCheckpoint(checkpoint_dir) if checkpoint_dir else None
+    parts = []
+    for index in indexes:
+        ranges = checkpoint.get_ranges(index) if checkpoint else None
+        if ranges is None:
+            ranges = get_id_ranges(SearchableMixin.get_model(index), workers)
+            if checkpoint:
+                checkpoint.set_ranges(index, ranges)
+        parts += [
+            (index, part, start_id, end_id)
+            for part, (start_id, end_id) in enumerate(ranges)
+        ]
+    counts = dict.fromkeys(indexes, 0)
+    if workers == 1:
+        for index, part, start_id, end_id in parts:
+            counts[index] += reindex_part(
+                index,
+                part,
+                start_id,
+                end_id,
+                chunk_size,
+                checkpoint_dir,
+                targets.get(index),
+            )
+        return counts
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(config_name,)
+    ) as pool:
+        futures = [
+            (
+                index,
+                pool.submit(
+                    reindex_part,
+                    index,
+                    part,
+                    start_id,
+                    end_id,
+                    chunk_size,
+                    checkpoint_dir,
+                    targets.get(index),
+                ),
+            )
+            for index, part, start_id, end_id in parts
+        ]
+        for index, future in futures:
+            counts[index] += future.result()
+    return counts
+
+
+def rebuild(
+    indexes: List[str],
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    checkpoint_dir: str = None,
+    config_name: str = "default",
+    keep_old: bool = False,
+) -> dict:
+    """Load new versions of the indexes, then serve them without downtime
+
+    Searches use the current versions until the aliases are swapped, and the
+    changes made during the load are written to both versions. A resumed
+    rebuild keeps loading the version it created.
+
+    Returns:
+        [dict]: number of objects indexed by index
+    """
+    checkpoint = ReindexCheckpoint(checkpoint_dir) if checkpoint_dir else None
+    targets = {}
+    for index in indexes:
+        target = checkpoint.get_target(index) if checkpoint else None
+        if target is None:
+            target = create_index_version(
+                index, SearchableMixin.get_model(index).get_mapping()
+            )
+            if checkpoint:
+                checkpoint.set_target(index, target)
+        targets[index] = target
+    counts = reindex(
+        indexes, workers, chunk_size, checkpoint_dir, config_name, targets=targets
+    )
+    for index, target in targets.items():
+        previous = swap_index_version(
+            index, target, current_app.config["ELASTICSEARCH_REPLICAS"]
+        )
+        current_app.logger.info(f"Serving {index} from {target}")
+        if previous and not keep_old:
+            current_app.elasticsearch.indices.delete(index=",".join(previous))
+    if checkpoint:
+        checkpoint.clear()
+    return counts
@@ -0,0 +1,143 @@
+from typing import Iterator, Sequence, Tuple
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import bindparam
+
+from app.models import Card, LearnSpacedRepetition
+from app import db
+from app.cache import bump_generation
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def compute_next_dates(
+    buckets: np.ndarray,
+    next_dates: np.ndarray,
+    old_intervals: Sequence[int],
+    new_intervals: Sequence[int],
+    today: np.datetime64,
+) -> np.ndarray:
+    """Compute the next learning dates of many cards at once
+
+    A card keeps its position in the schedule: its next date is shifted by the
+    difference between the new and the old interval of its bucket. Mastered
+    cards have no next date, and cards missing one are due today.
+
+    Args:
+        buckets (np.ndarray): bucket of every card, as integers
+        next_dates (np.ndarray): current next dates as datetime64[D], NaT if
+            missing
+        old_intervals (Sequence[int]): days per bucket the dates were computed
+            with
+        new_intervals (Sequence[int]): days per bucket to reschedule with
+        today (np.datetime64): date given to cards missing a next date
+
+    Returns:
+        [np.ndarray]: new next dates as datetime64[D], NaT for mastered cards
+    """
+    max_bucket = LearnSpacedRepetition.get_max_bucket()
+    old_table = np.asarray(old_intervals, dtype="int64")
+    new_table = np.asarray(new_intervals, dtype="int64")
+    if old_table.shape != new_table.shape:
+        raise ValueError("Interval tables must have one entry per bucket")
+    index = np.clip(buckets, 0, len(new_table) - 1)
+    shift = (new_table[index] - old_table[index]).astype("timedelta64[D]")
+
+    new_dates = next_dates + shift
+    new_dates[np.isnat(next_dates)] = today
+    new_dates[buckets >= max_bucket] = np.datetime64("NaT")
+    return new_dates
+
+
+def iter_chunks(
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Load (id, bucket, next_date) of all cards as arrays, chunk by chunk
+
+    Chunks are read with keyset pagination on the primary key so every query
+    stays cheap however far the scan is.
+    """
+    table = LearnSpacedRepetition.__table__
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select([table.c.id, table.c.bucket, table.c.next_date])
+            .where(table.c.id > last_id)
+            .where(table.c.bucket.isnot(None))
+            .order_by(table.c.id)
+            .limit(chunk_size)
+        ).fetchall()
+        if not rows:
+            return
+        ids, buckets, next_dates = zip(*rows)
+        last_id = ids[-1]
+        yield (
+            np.array(ids, dtype="int64"),
+            np.array(buckets, dtype="int64"),
+            np.array(next_dates, dtype="datetime64[us]").astype("datetime64[D]"),
+        )
+
+
+def write_next_dates(ids: np.ndarray, next_dates: np.ndarray):
+    table = LearnSpacedRepetition.__table__
+    stmt = (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values(next_date=bindparam("_next_date"))
+    )
+    values = next_dates.astype("datetime64[s]").tolist()
+    db.session.execute(
+        stmt,
+        [
+            {"_id": _id, "_next_date": next_date}
+            for _id, next_date in zip(ids.tolist(), values)
+        ],
+    )
+
+
+def get_user_ids(ids: np.ndarray) -> list:
+    """Users owning the cards of the given learning rows"""
+    rows = db.session.execute(
+        db.select([Card.user_id])
+        .where(Card.learn_spaced_rep_id.in_(ids.tolist()))
+        .distinct()
+    )
+    return [user_id for user_id, in rows]
+
+
+def reschedule(
+    old_intervals: Sequence[int] = LearnSpacedRepetition.INTERVAL_DAYS,
+    new_intervals: Sequence[int] = LearnSpacedRepetition.INTERVAL_DAYS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    dry_run: bool = False,
+    today: datetime = None,
+) -> dict:
+    """Reschedule every card from one interval table to another
+
+    With the same table on both sides only the invalid next dates are repaired.
+    Only the rows whose next date changes are written, one bulk UPDATE and one
+    commit per chunk. The bulk UPDATEs bypass the session listeners, so the
+    cache generation of the owners is bumped after each committed chunk.
+
+    Returns:
+        [dict]: number of cards scanned and updated
+    """
+    today = np.datetime64((today or datetime.utcnow()).date(), "D")
+    stats = {"scanned": 0, "updated": 0}
+    for ids, buckets, next_dates in iter_chunks(chunk_size):
+        new_dates = compute_next_dates(
+            buckets, next_dates, old_intervals, new_intervals, today
+        )
+        changed = (new_dates != next_dates) & ~(
+            np.isnat(new_dates) & np.isnat(next_dates)
+        )
+        stats["scanned"] += len(ids)
+        stats["updated"] += int(changed.sum())
+        if dry_run or not changed.any():
+            continue
+        write_next_dates(ids[changed], new_dates[changed])
+        user_ids = get_user_ids(ids[changed])
+        db.session.commit()
+        bump_generation(user_ids)
+    return stats
@@ -1,37 +1,158 @@
+from hashlib import sha256
+
+from elasticsearch.exceptions import NotFoundError
 from flask import current_app
 from flask_login import current_user
 
+from app import cache
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    if hasattr(model, "user_id"):
-        payload["user_id"] = model.user_id
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+# Searches read the alias named as the index, writes resolve the write alias,
+# which points to the new version of the index as well during a rebuild.
+# Physical indexes are versioned, e.g. card_v3.
+VERSION_SEPARATOR = "_v"
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+class BulkIndexError(Exception):
+    """Some documents of a bulk request were not indexed"""
 
+    def __init__(self, items):
+        super().__init__(f"{len(items)} documents not indexed, first: {items[0]}")
+        self.items = items
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    query_str = {
-        "query": {
-            "bool": {
-                "must": {"multi_match": {"query": query, "fields": ["*"]}},
-                "filter": {"term": {"user_id": current_user.id}},
-            }
+
+def bulk_index(index, documents, op_type="index"):
+    """Index many documents with a single bulk request
+
+    Args:
+        documents (list): (id, document) pairs
+        op_type (str): "create" keeps the documents which already exist
+
+    Returns:
+        [list]: results of the documents which were not indexed
+    """
+    if not current_app.elasticsearch or not documents:
+        return []
+    body = []
+    for id, document in documents:
+        body.append({op_type: {"_index": index, "_id": id}})
+        body.append(document)
+    response = current_app.elasticsearch.bulk(body=body)
+    if not response["errors"]:
+        return []
+    return [
+        item[op_type]
+        for item in response["items"]
+        if item[op_type]["status"] >= 300
+        and not (op_type == "create" and item[op_type]["status"] == 409)
+    ]
+
+
+def get_write_alias(index):
+    return f"{index}_write"
+
+
+def _get_alias_indexes(alias):
+    try:
+        return set(current_app.elasticsearch.indices.get_alias(name=alias))
+    except NotFoundError:
+        return set()
+
+
+def get_write_indexes(index):
+    """Physical indexes to write the documents of an index to"""
+    # An index not rebuilt with aliases yet is written directly
+    return sorted(_get_alias_indexes(get_write_alias(index))) or [index]
+
+
+def create_index_version(index, mapping):
+    """Create the next version of an index, ready for a bulk load
+
+    Refresh and replicas are disabled until swap_index_version. The new
+    version joins the write alias at once, so that the changes made during
+    the load are written to both versions.
+
+    Returns:
+        [str]: name of the new version
+    """
+    es = current_app.elasticsearch
+    versions = [
+        int(name.rsplit(VERSION_SEPARATOR, 1)[1])
+        for name in es.indices.get(index=f"{index}{VERSION_SEPARATOR}*")
+    ]
+    name = f"{index}{VERSION_SEPARATOR}{max(versions, default=0) + 1}"
+    es.indices.create(
+        index=name,
+        body={
+            "settings": {"number_of_replicas": 0, "refresh_interval": "-1"},
+            "mappings": mapping,
         },
-        "from": (page - 1) * per_page,
-        "size": per_page,
-    }
-    search = current_app.elasticsearch.search(index=index, body=query_str)
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
+    )
+    write_alias = get_write_alias(index)
+    if not es.indices.exists_alias(name=write_alias) and es.indices.exists(index=index):
+        es.indices.put_alias(index=index, name=write_alias)
+    es.indices.put_alias(index=name, name=write_alias)
+    return name
+
+
+def swap_index_version(index, name, replicas):
+    """Serve and write an index from its version `name` only
+
+    Restores refresh and replicas, then moves both aliases in one atomic
+    request. An index created before the aliases is removed by the same
+    request, as its name becomes the read alias.
+
+    Returns:
+        [list]: the previous versions, which nothing uses anymore
+    """
+    es = current_app.elasticsearch
+    es.indices.put_settings(
+        index=name,
+        body={"index": {"number_of_replicas": replicas, "refresh_interval": None}},
+    )
+    es.indices.refresh(index=name)
+    write_alias = get_write_alias(index)
+    readers = _get_alias_indexes(index)
+    writers = _get_alias_indexes(write_alias)
+    actions = [
+        {"add": {"index": name, "alias": index}},
+        {"add": {"index": name, "alias": write_alias}},
+    ]
+    actions += [
+        {"remove": {"index": old, "alias": index}} for old in sorted(readers - {name})
+    ]
+    actions += [
+        {"remove": {"index": old, "alias": write_alias}}
+        for old in sorted(writers - {name, index})
+    ]
+    if not readers and es.indices.exists(index=index):
+        actions.append({"remove_index": {"index": index}})
+    es.indices.update_aliases(body={"actions": actions})
+    return sorted((readers | writers) - {name, index})
+
+
+def query_index(index, query, page, per_page):
+    """Search the objects of the current user, with the ids cached by query
+
+    The first SEARCH_CACHE_RESULTS ids of a query are searched and cached at
+    once, so that paging through them needs no search. They are keyed by the
+    "search" generation of the user, bumped by the commits changing indexed
+    fields of their objects and once these changes are indexed.
+    """
+    backend = current_app.search_backend
+    user_id = current_user.id
+    query = " ".join(query.lower().split())
+    start = (page - 1) * per_page
+    limit = current_app.config["SEARCH_CACHE_RESULTS"]
+    key = None
+    if start + per_page <= limit:
+        digest = sha256(query.encode()).hexdigest()
+        key = cache.user_key(user_id, "search", index, digest, kind="search")
+    if key is None:
+        return backend.query_index(index, query, page, per_page, user_id)
+    result = cache.get(key)
+    if result is None:
+        ids, total = backend.query_index(index, query, 1, limit, user_id)
+        result = {"ids": ids, "total": total}
+        cache.set(key, result, current_app.config["SEARCH_CACHE_TTL"])
+    end = start + per_page
+    return result["ids"][start:end], result["total"]
@@ -0,0 +1,200 @@
+"""Search backends behind query_index
+
+Elasticsearch is written through the outbox drain. The database backends
+index in the database itself, SQLite with FTS5 tables kept in sync by
+triggers and Postgres with a GIN index on a tsvector expression, so that
+they never miss a change and need no indexing calls.
+"""
+import re
+from abc import ABC, abstractmethod
+
+from flask import current_app
+from sqlalchemy import DDL, event, text
+
+from app import db
+
+# Text search configuration of Postgres. The cards are written in any
+# language, so words are only lowercased.
+TS_CONFIG = "simple"
+WORD = re.compile(r"\w+")
+
+
+def get_words(query):
+    return WORD.findall(query.lower())
+
+
+class SearchBackend(ABC):
+    @abstractmethod
+    def query_index(self, index, query, page, per_page, user_id):
+        """Search the objects of a user matching any word of the query
+
+        Returns:
+            [Tuple[list, int]]: ids of the page, best match first, and the
+                number of matching objects
+        """
+
+
+class ElasticsearchBackend(SearchBackend):
+    def query_index(self, index, query, page, per_page, user_id):
+        if not current_app.elasticsearch:
+            return [], 0
+        query_str = {
+            "query": {
+                "bool": {
+                    "must": {
+                        "multi_match": {
+                            "query": query,
+                            "fields": ["*"],
+                            "lenient": True,
+                        }
+                    },
+                    "filter": {"term": {"user_id": user_id}},
+                }
+            },
+            "from": (page - 1) * per_page,
+            "size": per_page,
+        }
+        search = current_app.elasticsearch.search(index=index, body=query_str)
+        ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+        return ids, search["hits"]["total"]["value"]
+
+
+class DatabaseBackend(SearchBackend):
+    """Full-text search of the database, indexed by the database itself
+
+    Cards also match by the names of their tags, in the same query, so that
+    the ids are deduplicated and counted once.
+    """
+
+    # Common table expression of the matches, named matches
+    MATCHES_CTE = "WITH matches AS ({})"
+
+    @abstractmethod
+    def _matches(self, index):
+        """SQL of the (id, rank) of the matching objects, best rank highest"""
+
+    @abstractmethod
+    def _params(self, words):
+        """Bind parameters of the words for _matches"""
+
+    def query_index(self, index, query, page, per_page, user_id):
+        words = get_words(query)
+        if not words:
+            return [], 0
+        matches = self._matches(index)
+        if index == "card":
+            # Tags rank after the text matches
+            matches += (
+                f" UNION ALL SELECT tagging.card_id AS id, 0 AS rank "
+                f"FROM ({self._matches('tag')}) AS tags "
+                "JOIN tagging ON tagging.tag_id = tags.id"
+            )
+        params = self._params(words)
+        params.update(user_id=user_id, limit=per_page, offset=(page - 1) * per_page)
+        cte = self.MATCHES_CTE.format(matches)
+        ids_query = text(
+            f"{cte} SELECT id FROM matches "
+            "GROUP BY id ORDER BY max(rank) DESC, id LIMIT :limit OFFSET :offset"
+        )
+        count_query = text(f"{cte} SELECT count(DISTINCT id) FROM matches")
+        ids = [row[0] for row in db.session.execute(ids_query, params)]
+        return ids, db.session.execute(count_query, params).scalar()
+
+
+class SQLiteFTSBackend(DatabaseBackend):
+    # bm25 can not be evaluated once the query is flattened into the grouping.
+    # A LIMIT keeps it from being flattened, on every SQLite version with
+    # FTS5, where MATERIALIZED needs SQLite 3.35.
+    MATCHES_CTE = "WITH matches AS ({} LIMIT -1)"
+
+    def _matches(self, index):
+        # bm25 is lower for better matches, and negative
+        return (
+            f"SELECT {index}.id AS id, -bm25({index}_fts) AS rank "
+            f"FROM {index}_fts JOIN {index} ON {index}.id = {index}_fts.rowid "
+            f"WHERE {index}_fts MATCH :match AND {index}.user_id = :user_id"
+        )
+
+    def _params(self, words):
+        # Quoted words, so that none of them is read as FTS5 syntax
+        return {"match": " OR ".join(f'"{word}"' for word in words)}
+
+
+class PostgresFTSBackend(DatabaseBackend):
+    def _matches(self, index):
+        document = get_tsvector(SEARCH_FIELDS[index])
+        tsquery = f"to_tsquery('{TS_CONFIG}', :tsquery)"
+        return (
+            f"SELECT id, ts_rank({document}, {tsquery}) AS rank FROM {index} "
+            f"WHERE {document} @@ {tsquery} AND user_id = :user_id"
+        )
+
+    def _params(self, words):
+        return {"tsquery": " | ".join(words)}
+
+
+def create_backend(name, dialect):
+    if name == "elasticsearch":
+        return ElasticsearchBackend()
+    if name == "database":
+        if dialect == "sqlite":
+            return SQLiteFTSBackend()
+        if dialect == "postgresql":
+            return PostgresFTSBackend()
+        raise ValueError(f"No database search backend for {dialect}")
+    raise ValueError(f"Unknown search backend {name}")
+
+
+# Searchable fields by table, set by register_search_ddl
+SEARCH_FIELDS = {}
+
+
+def get_tsvector(fields):
+    """The expression of the Postgres GIN index, queries must use it as is"""
+    document = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+    return f"to_tsvector('{TS_CONFIG}', {document})"
+
+
+def get_sqlite_ddl(table, fields):
+    """FTS5 table with the content of `table`, and its sync triggers"""
+    columns = ", ".join(fields)
+    new_values = ", ".join(f"new.{field}" for field in fields)
+    old_values = ", ".join(f"old.{field}" for field in fields)
+    insert = f"INSERT INTO {table}_fts(rowid, {columns}) VALUES (new.id, {new_values});"
+    delete = (
+        f"INSERT INTO {table}_fts({table}_fts, rowid, {columns}) "
+        f"VALUES ('delete', old.id, {old_values});"
+    )
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+        f"{columns}, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update "
+        f"AFTER UPDATE OF {columns} ON {table} BEGIN {delete} {insert} END",
+    ]
+
+
+def get_postgres_ddl(table, fields):
+    return [
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+        f"USING GIN ({get_tsvector(fields)})"
+    ]
+
+
+def register_search_ddl(table, fields):
+    """Create the full-text index of a table with the table"""
+    SEARCH_FIELDS[table.name] = fields
+    for statement in get_sqlite_ddl(table.name, fields):
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(
+        table,
+        "before_drop",
+        DDL(f"DROP TABLE IF EXISTS {table.name}_fts").execute_if(dialect="sqlite"),
+    )
+    for statement in get_postgres_ddl(table.name, fields):
+        event.listen(
+            table, "after_create", DDL(statement).execute_if(dialect="postgresql")
+        )
@@ -0,0 +1,239 @@
+from typing import Iterator, List, Sequence, Tuple
+from datetime import date
+
+import numpy as np
+
+from app.models import LearningSessionFact, LearnSpacedRepetition
+from app import db
+
+DEFAULT_CHUNK_SIZE = 100000
+# Next day of a card which is not due anymore
+NOT_DUE = -1
+# Day numbers count the days since 1970-01-01, as datetime64[D]
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class IntervalScheduler:
+    """Bucket scheduler of LearningHelper with a pluggable interval table
+
+    A scheduler computes the next state of many cards at once. Any object with
+    the same `initial_bucket`, `max_bucket` and `schedule` can be simulated.
+    """
+
+    initial_bucket = 1
+
+    def __init__(
+        self,
+        intervals: Sequence[int] = LearnSpacedRepetition.INTERVAL_DAYS,
+        name: str = None,
+    ):
+        self.intervals = np.asarray(intervals, dtype="int64")
+        self.max_bucket = LearnSpacedRepetition.get_max_bucket()
+        self.name = name or ",".join(str(day) for day in intervals)
+
+    def schedule(
+        self, buckets: np.ndarray, days: np.ndarray, is_ok: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Answer the cards on the given days
+
+        Args:
+            buckets (np.ndarray): current bucket of every card
+            days (np.ndarray): day number of the answers
+            is_ok (np.ndarray): answers, as booleans
+
+        Returns:
+            [Tuple[np.ndarray, np.ndarray]]: new buckets and next day numbers,
+                NOT_DUE for mastered cards
+        """
+        new_buckets = np.where(is_ok, np.minimum(buckets + 1, self.max_bucket), 1)
+        index = np.clip(new_buckets, 0, len(self.intervals) - 1)
+        next_days = np.where(is_ok, days + self.intervals[index], days)
+        next_days[new_buckets >= self.max_bucket] = NOT_DUE
+        return new_buckets, next_days
+
+
+class DailyHistogram:
+    """Number of reviews per day, grown as new days are seen"""
+
+    def __init__(self):
+        self.first_day = None
+        self.counts = np.zeros(0, dtype="int64")
+
+    def add(self, days: np.ndarray):
+        if len(days) == 0:
+            return
+        low, high = int(days.min()), int(days.max())
+        if self.first_day is None:
+            self.first_day = low
+        if low < self.first_day:
+            self.counts = np.concatenate(
+                [np.zeros(self.first_day - low, dtype="int64"), self.counts]
+            )
+            self.first_day = low
+        size = high - self.first_day + 1
+        if size > len(self.counts):
+            self.counts = np.concatenate(
+                [self.counts, np.zeros(size - len(self.counts), dtype="int64")]
+            )
+        self.counts += np.bincount(days - self.first_day, minlength=len(self.counts))
+
+    def to_dict(self):
+        active = self.counts[self.counts > 0]
+        return {
+            "first_day": (
+                date.fromordinal(self.first_day + EPOCH_ORDINAL).isoformat()
+                if self.first_day is not None
+                else None
+            ),
+            "counts": self.counts.tolist(),
+            "mean": float(active.mean()) if len(active) else 0.0,
+            "p95": float(np.percentile(active, 95)) if len(active) else 0.0,
+            "max": int(self.counts.max()) if len(self.counts) else 0,
+        }
+
+
+class Replay:
+    """Per-scheduler accumulators of a simulation"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.workload = DailyHistogram()
+        self.num_cards = 0
+        self.num_mastered = 0
+        self.reviews_to_mastery = 0
+
+    def run(self, slots: np.ndarray, ranks: np.ndarray, days, is_ok, num_cards):
+        """Replay the answers of complete cards through the scheduler
+
+        Answers are replayed in order, one review step at a time for all the
+        cards at once. A card is reviewed on the day it is due, or on the day
+        of its real answer when it is not due.
+        """
+        scheduler = self.scheduler
+        buckets = np.full(num_cards, scheduler.initial_bucket, dtype="int64")
+        next_days = np.full(num_cards, NOT_DUE, dtype="int64")
+        mastered_after = np.zeros(num_cards, dtype="int64")
+        simulated_days = np.empty(len(days), dtype="int64")
+        # Facts grouped by rank, each group being one review step
+        order = np.argsort(ranks, kind="stable")
+        bounds = np.cumsum(np.bincount(ranks))
+        start = 0
+        for rank, end in enumerate(bounds):
+            index = order[start:end]
+            start = end
+            cards = slots[index]
+            due = next_days[cards]
+            review_days = np.where(due != NOT_DUE, due, days[index])
+            simulated_days[index] = review_days
+            buckets[cards], next_days[cards] = scheduler.schedule(
+                buckets[cards], review_days, is_ok[index]
+            )
+            newly_mastered = (mastered_after[cards] == 0) & (
+                buckets[cards] >= scheduler.max_bucket
+            )
+            mastered_after[cards[newly_mastered]] = rank + 1
+        self.workload.add(simulated_days)
+        self.num_cards += num_cards
+        self.num_mastered += int((mastered_after > 0).sum())
+        self.reviews_to_mastery += int(mastered_after.sum())
+
+    def to_dict(self):
+        return {
+            "scheduler": self.scheduler.name,
+            "num_cards": self.num_cards,
+            "num_mastered": self.num_mastered,
+            "mastery_rate": (
+                self.num_mastered / self.num_cards if self.num_cards else 0.0
+            ),
+            "mean_reviews_to_mastery": (
+                self.reviews_to_mastery / self.num_mastered
+                if self.num_mastered
+                else None
+            ),
+            "daily_workload": self.workload.to_dict(),
+        }
+
+
+def _to_arrays(rows):
+    card_ids, complete_ats, is_ok = zip(*rows)
+    days = (
+        np.array(complete_ats, dtype="datetime64[us]")
+        .astype("datetime64[D]")
+        .astype("int64")
+    )
+    return (
+        np.array(card_ids, dtype="int64"),
+        days,
+        np.array(is_ok, dtype=bool),
+    )
+
+
+def iter_card_chunks(
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Stream the answered facts as (card_id, day, is_ok) arrays
+
+    Facts are ordered by (card_id, complete_at) and read through a server side
+    cursor when the database has one. A chunk always holds the whole history
+    of its cards, the facts of the last card are carried to the next chunk.
+    """
+    table = LearningSessionFact.__table__
+    result = (
+        db.session.connection()
+        .execution_options(stream_results=True)
+        .execute(
+            db.select([table.c.card_id, table.c.complete_at, table.c.is_ok])
+            .where(table.c.complete_at.isnot(None))
+            .where(table.c.is_ok.isnot(None))
+            .order_by(table.c.card_id, table.c.complete_at, table.c.id)
+        )
+    )
+    carry = None
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        card_ids, days, is_ok = _to_arrays(rows)
+        if carry is not None:
+            card_ids, days, is_ok = (
+                np.concatenate([previous, current])
+                for previous, current in zip(carry, (card_ids, days, is_ok))
+            )
+        last_start = np.searchsorted(card_ids, card_ids[-1])
+        carry = (card_ids[last_start:], days[last_start:], is_ok[last_start:])
+        if last_start > 0:
+            yield card_ids[:last_start], days[:last_start], is_ok[:last_start]
+    if carry is not None:
+        yield carry
+
+
+def simulate(schedulers: List, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Replay the whole review history through several schedulers in one pass
+
+    The real answers of every card are replayed in order, only their days
+    change with the intervals of each scheduler. Memory is bounded by the
+    chunk size, and per-card state lives in arrays for the current chunk only.
+
+    Returns:
+        [dict]: number of facts, the real daily workload and one report of
+            workload and mastery per scheduler
+    """
+    replays = [Replay(scheduler) for scheduler in schedulers]
+    actual = DailyHistogram()
+    num_facts = 0
+    for card_ids, days, is_ok in iter_card_chunks(chunk_size):
+        is_start = np.empty(len(card_ids), dtype=bool)
+        is_start[0] = True
+        np.not_equal(card_ids[1:], card_ids[:-1], out=is_start[1:])
+        starts = np.flatnonzero(is_start)
+        slots = np.cumsum(is_start) - 1
+        ranks = np.arange(len(card_ids)) - starts[slots]
+        for replay in replays:
+            replay.run(slots, ranks, days, is_ok, len(starts))
+        actual.add(days)
+        num_facts += len(card_ids)
+    return {
+        "num_facts": num_facts,
+        "actual_daily_workload": actual.to_dict(),
+        "schedulers": [replay.to_dict() for replay in replays],
+    }
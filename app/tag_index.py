@@ -0,0 +1,75 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+MAX_TAG_SUGGESTIONS = 100
+
+
+class TagPrefixIndex:
+    """Per-process LRU cache of the tag names of users, sorted for prefix search
+
+    An entry holds the lowercased names sorted, for bisect, and the names
+    themselves. It is valid for `ttl` seconds and as long as the "tags"
+    generation of its user is the one it was built at, so that the changes
+    made by the other processes drop it too. The commits of this process
+    drop the entries of the users whose tags they change.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id: int, generation):
+        """Return the (keys, names) of a user, None if not cached"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < monotonic() or entry[1] != generation:
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, user_id: int, generation, names) -> tuple:
+        """Index the tag names of a user
+
+        Returns:
+            [tuple]: the (keys, names) of the user
+        """
+        pairs = sorted((name.lower(), name) for name in names if name)
+        value = ([key for key, _ in pairs], [name for _, name in pairs])
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, generation, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    @staticmethod
+    def search(value: tuple, prefix: str, limit: int) -> list:
+        """Names starting with prefix, case insensitive, in alphabetical order"""
+        keys, names = value
+        prefix = prefix.lower()
+        start = bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and end - start < limit and keys[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -5,7 +5,7 @@ from flask import render_template
 from rq import get_current_job
 
 from app import create_app
-from app.models import Task, User, Card
+from app.models import Task, User, Card, Tag, SearchIndexOutbox
 from app import db
 from app.email import send_email
 
@@ -57,3 +57,25 @@ def export_cards(user_id):
         app.logger.error("Unhandled exception", exc_info=sys.exc_info())
     finally:
         _set_task_progress(100)
+
+
+def delete_tag(user_id, tag_id):
+    try:
+        _set_task_progress(0)
+        Tag.delete_in_chunks(tag_id, set_progress=_set_task_progress)
+    except Exception:
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+    finally:
+        _set_task_progress(100)
+
+
+def drain_search_outbox():
+    # A change committed from now on schedules a new drain
+    app.redis.delete(SearchIndexOutbox.SCHEDULED_KEY)
+    # One drain at a time, so that an older document never overwrites a newer one
+    with app.redis.lock(SearchIndexOutbox.LOCK_KEY, timeout=600, blocking_timeout=600):
+        sent, failed = SearchIndexOutbox.drain()
+    app.logger.info(f"Search index outbox: {sent} sent, {failed} failed")
+    if failed:
+        # Let rq retry the drain later
+        raise RuntimeError(f"{failed} search index changes failed")
@@ -24,10 +24,33 @@ class Config(object):
     CARDS_PER_PAGE = 6
     # Full-text search
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
+    # "elasticsearch", or "database" for the full-text search of SQLite or
+    # Postgres
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND") or (
+        "elasticsearch" if ELASTICSEARCH_URL else "database"
+    )
+    # Ids cached by search query and user, and for how many seconds
+    SEARCH_CACHE_RESULTS = int(os.environ.get("SEARCH_CACHE_RESULTS") or 120)
+    SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL") or 60 * 10)
+    # Replicas of the indexes, restored after a rebuild
+    ELASTICSEARCH_REPLICAS = int(os.environ.get("ELASTICSEARCH_REPLICAS") or 1)
     # Logging
     LOG_TO_STDOUT = os.environ.get("LOG_TO_STDOUT")
     # Redis
     REDIS_URL = os.environ.get("REDIS_URL") or "redis://"
+    # Seconds a cached value lives at most, even if nothing invalidates it
+    CACHE_TTL = 60 * 60 * 24
+    # Seconds between two recorded activities of a user, and between two
+    # bulk writes of last_seen
+    LAST_SEEN_GRANULARITY = int(os.environ.get("LAST_SEEN_GRANULARITY") or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 30)
+    # Users kept per process by login and token auth, and for how many seconds
+    IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE") or 1024)
+    IDENTITY_CACHE_TTL = int(os.environ.get("IDENTITY_CACHE_TTL") or 30)
+    # Users whose tag names are indexed per process for autocompletion, and
+    # for how many seconds
+    TAG_INDEX_SIZE = int(os.environ.get("TAG_INDEX_SIZE") or 1024)
+    TAG_INDEX_TTL = int(os.environ.get("TAG_INDEX_TTL") or 300)
     # Uploaded images
     MAX_CONTENT_LENGTH = 1024 * 1024 * 5  # 5 MB
     UPLOAD_EXTENSIONS = [".jpg", ".png", ".gif"]
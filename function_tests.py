@@ -1,12 +1,39 @@
 import re
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import unittest
 import threading
+import tempfile
+from collections import defaultdict
+from types import SimpleNamespace
 import time
 
-from app import create_app, db
-from app.models import User, Tag, Tagging, Card, LearnSpacedRepetition
+from app import cache, create_app, db
+from app.models import (
+    User,
+    Tag,
+    Tagging,
+    Card,
+    LearnSpacedRepetition,
+    LearningSession,
+    LearningSessionFact,
+    LearningSessionState,
+    UserStats,
+    SearchIndexOutbox,
+)
+from app.activity import LastSeenBuffer
+from app.identity import IdentityCache
+from app.learning import LearningHelper
+from app.rescheduling import reschedule
+from app.simulation import IntervalScheduler, simulate
+from app.reindexing import rebuild, reindex, get_id_ranges, ReindexCheckpoint
+from app.search import (
+    BulkIndexError,
+    create_index_version,
+    get_write_indexes,
+    swap_index_version,
+)
+from elasticsearch.exceptions import NotFoundError
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -93,6 +120,187 @@ class AuthTest(FlaskClientTestCase):
         )
         self.assertEqual(response.status_code, 302)
 
+    def test_last_seen_is_buffered(self):
+        user = User.query.filter_by(username="admin").first()
+        user.last_seen = datetime.utcnow() - timedelta(days=1)
+        db.session.commit()
+        buffer = self.app.last_seen_buffer
+        self.client.get("/index")
+        self.client.get("/index")
+        seen = buffer.get(user.id)
+        self.assertIsNotNone(seen)
+        # Nothing is written by the requests themselves
+        db.session.expire_all()
+        self.assertLess(user.last_seen, seen)
+        self.assertEqual(user.get_last_seen(), seen)
+        self.assertEqual(buffer.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(user.last_seen, seen)
+        # Recent activity is not recorded again
+        self.client.get("/index")
+        self.assertIsNone(buffer.get(user.id))
+
+    def test_last_seen_flushed_without_requests(self):
+        buffer = LastSeenBuffer(flush_interval=0.05)
+        buffer.start(self.app)
+        seen = datetime.utcnow()
+        buffer.touch(1, seen - timedelta(days=1), seen)
+        for _ in range(100):
+            if buffer.get(1) is None:
+                break
+            time.sleep(0.02)
+        buffer.stop(self.app)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(1).last_seen, seen)
+        # Activity recorded after the last tick is written at exit
+        buffer.touch(1, None, seen + timedelta(hours=1))
+        buffer.stop(self.app)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(1).last_seen, seen + timedelta(hours=1))
+
+    def test_identity_cache(self):
+        self.app.redis = FakeRedis()
+        cache._unavailable_until = 0
+        user = User.query.filter_by(username="admin").first()
+        user_id = user.id
+        token = user.get_token()
+        db.session.commit()
+        identities = self.app.identity_cache
+        headers = {"Authorization": f"Bearer {token}"}
+        user_queries = []
+
+        def count_user_queries(conn, cursor, statement, *args):
+            if re.search(r"FROM user\b", statement):
+                user_queries.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", count_user_queries)
+        self.addCleanup(
+            db.event.remove, db.engine, "before_cursor_execute", count_user_queries
+        )
+        db.session.remove()
+        response = self.client.get(f"/api/users/{user_id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        # Warm, API calls and page loads read no user
+        misses, hits = identities.misses, identities.hits
+        user_queries.clear()
+        for _ in range(2):
+            db.session.remove()
+            response = self.client.get(f"/api/users/{user_id}", headers=headers)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_queries, [])
+        self.assertEqual(identities.misses, misses)
+        # The token and the user of each call
+        self.assertEqual(identities.hits, hits + 4)
+        db.session.remove()
+        self.assertEqual(self.client.get("/index").status_code, 200)
+        hits = identities.hits
+        user_queries.clear()
+        db.session.remove()
+        self.assertEqual(self.client.get("/index").status_code, 200)
+        self.assertEqual(user_queries, [])
+        self.assertEqual(identities.hits, hits + 1)
+        # A revoked token is rejected at once
+        db.session.remove()
+        response = self.client.delete("/api/tokens", headers=headers)
+        self.assertEqual(response.status_code, 204)
+        db.session.remove()
+        response = self.client.get(f"/api/users/{user_id}", headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_identity_cache_processes(self):
+        self.app.redis = FakeRedis()
+        cache._unavailable_until = 0
+        # The identity caches of two worker processes
+        first, second = self.app.identity_cache, IdentityCache()
+        for identities in (first, second):
+            self.app.identity_cache = identities
+            db.session.remove()
+            User.get_cached(1)
+        db.session.remove()
+        User.get_cached(1)
+        self.assertEqual(second.hits, 1)
+        # Changes committed by the first process
+        self.app.identity_cache = first
+        db.session.remove()
+        user = User.get_cached(1)
+        user.username = "renamed"
+        user.set_current_ls_id(7)
+        token = user.get_token()
+        db.session.commit()
+        self.app.identity_cache = second
+        db.session.remove()
+        user = User.get_cached(1)
+        self.assertEqual((user.username, user.current_ls_id), ("renamed", 7))
+        self.assertEqual(User.check_token(token).id, 1)
+        self.app.identity_cache = first
+        db.session.remove()
+        User.get_cached(1).revoke_token()
+        db.session.commit()
+        self.app.identity_cache = second
+        db.session.remove()
+        self.assertIsNone(User.check_token(token))
+        # Without Redis, the session and token state are still read from the
+        # database
+        cache._unavailable_until = time.time() + cache.RETRY_AFTER
+        db.session.remove()
+        User.get_cached(1)
+        self.app.identity_cache = first
+        db.session.remove()
+        User.get_cached(1).set_current_ls_id(8)
+        db.session.commit()
+        self.app.identity_cache = second
+        db.session.remove()
+        self.assertEqual(User.get_cached(1).current_ls_id, 8)
+
+
+class UserStatsTest(FlaskClientTestCase):
+    def test_counts_follow_cards_and_tags(self):
+        user = User.query.get(1)
+        self.assertEqual(user.to_dict()["card_count"], 1)
+        self.assertEqual(user.to_dict()["tag_count"], 1)
+        quick_create_card(self.client, 2)
+        db.session.add(Tag(name="other", user_id=1))
+        db.session.commit()
+        self.client.post("card/1/delete_card")
+        stats = UserStats.query.get(1)
+        self.assertEqual((stats.card_count, stats.tag_count), (1, 2))
+
+    def test_concurrent_first_insert(self):
+        UserStats.query.filter_by(user_id=1).delete()
+        db.session.commit()
+        inserted = []
+
+        def insert_row(conn, cursor, statement, parameters, context, executemany):
+            # Another transaction inserts the row between the update and the
+            # insert
+            if statement.startswith("UPDATE user_stats") and not inserted:
+                inserted.append(True)
+                cursor.connection.cursor().execute(
+                    "INSERT INTO user_stats VALUES (1, 10, 20)"
+                )
+
+        db.event.listen(db.engine, "after_cursor_execute", insert_row)
+        try:
+            UserStats.add(db.session.connection(), 1, card_delta=1, tag_delta=1)
+        finally:
+            db.event.remove(db.engine, "after_cursor_execute", insert_row)
+        db.session.commit()
+        stats = UserStats.query.get(1)
+        self.assertEqual((stats.card_count, stats.tag_count), (11, 21))
+
+    def test_repair(self):
+        stats = UserStats.query.get(1)
+        stats.card_count = 42
+        other = User(username="other", email="other@example.com")
+        db.session.add(other)
+        db.session.commit()
+        UserStats.query.filter_by(user_id=other.id).delete()
+        db.session.commit()
+        self.assertEqual(UserStats.repair(), 2)
+        self.assertEqual(UserStats.query.get(1).card_count, 1)
+        self.assertEqual(UserStats.query.get(other.id).card_count, 0)
+        self.assertEqual(UserStats.repair(), 0)
+
 
 class TagTest(FlaskClientTestCase):
     def test_create_tag(self):
@@ -119,6 +327,84 @@ class TagTest(FlaskClientTestCase):
             re.search("Your tag is edited!", response.get_data(as_text=True))
         )
 
+    def test_delete_tag_in_chunks(self):
+        for num in range(2, 6):
+            quick_create_card(self.client, num)
+        image = os.path.join("app", self.app.config["UPLOAD_PATH"], "test_img.png")
+        with open(image, "wb") as f:
+            f.write(b"")
+        card = Card.query.get(3)
+        card.back = f'<img src="/{self.app.config["UPLOAD_PATH"]}/test_img.png">'
+        db.session.commit()
+        progress = []
+        Tag.delete_in_chunks(1, chunk_size=2, set_progress=progress.append)
+        self.assertEqual(progress, [40, 80, 99])
+        self.assertEqual(Tag.query.all(), [])
+        self.assertEqual(Tagging.query.all(), [])
+        self.assertEqual(Card.query.count(), 5)
+        # The images of the kept cards are kept
+        self.assertTrue(os.path.exists(image))
+        os.remove(image)
+        self.assertEqual(UserStats.query.get(1).tag_count, 0)
+
+    def test_tag_profile_pagination(self):
+        for num in range(2, 9):
+            quick_create_card(self.client, num)
+        response = self.client.get("/tag/1")
+        data = response.get_data(as_text=True)
+        self.assertTrue(re.search("8 cards", data))
+        # Last tagged first
+        self.assertTrue(re.search("card 8", data))
+        self.assertFalse(re.search("card 2", data))
+        response = self.client.get("/tag/1?page=2")
+        data = response.get_data(as_text=True)
+        self.assertTrue(re.search("card 2", data))
+        self.assertTrue(re.search("front", data))
+
+    def test_tag_counts(self):
+        quick_create_card(self.client, 2)
+        quick_create_card(self.client, 3)
+        LearnSpacedRepetition.query.get(3).bucket = 6
+        db.session.add(Tag(name="empty", user_id=1))
+        db.session.commit()
+        counts = Tag.get_counts(1)
+        self.assertEqual(counts[1], {"card_count": 3, "due_today": 2, "mastered": 1})
+        self.assertEqual(counts[2]["card_count"], 0)
+        response = self.client.get("/tag")
+        data = response.get_data(as_text=True)
+        self.assertTrue(re.search("3 cards", data))
+        self.assertTrue(re.search("2 due today", data))
+        self.assertTrue(re.search("0 cards", data))
+
+    def test_tag_prefix_index(self):
+        self.app.redis = FakeRedis()
+        cache._unavailable_until = 0
+        for name in ["Python", "pytest", "java"]:
+            db.session.add(Tag(name=name, user_id=1))
+        db.session.commit()
+        response = self.client.get("/get_user_tags?prefix=PY&limit=5")
+        self.assertEqual(response.get_json()["data"], ["pytest", "Python"])
+        response = self.client.get("/get_user_tags?prefix=py&limit=1")
+        self.assertEqual(response.get_json()["data"], ["pytest"])
+        self.assertEqual(self.app.tag_index.stats()["hits"], 1)
+        # Renames drop the index of the user
+        Tag.query.filter_by(name="java").one().name = "pyramid"
+        db.session.commit()
+        response = self.client.get("/get_user_tags?prefix=py")
+        self.assertEqual(response.get_json()["data"], ["pyramid", "pytest", "Python"])
+        response = self.client.get("/get_user_tags?prefix=py&limit=0")
+        self.assertEqual(response.status_code, 400)
+        # Only tag changes drop it, in every process
+        tag_index = self.app.tag_index
+        quick_create_card(self.client, 2)
+        Card.query.get(2).learn_spaced_rep.bucket = 3
+        db.session.commit()
+        self.client.get("/get_user_tags?prefix=py")
+        self.assertEqual(tag_index.stats()["misses"], 2)
+        cache.bump_generation([1], "tags")
+        self.client.get("/get_user_tags?prefix=py")
+        self.assertEqual(tag_index.stats()["misses"], 3)
+
     def test_delete_tag(self):
         # Delete tag
         response = self.client.post("/tag/1/delete_tag")
@@ -167,6 +453,17 @@ class CardTest(FlaskClientTestCase):
         )
         self.assertEqual(Card.query.first().front, "test edit")
 
+    def test_card_tags(self):
+        for name in ["b", "a"]:
+            tag = Tag(name=name, user_id=1)
+            db.session.add(tag)
+            db.session.add(Tagging(tag=tag, card_id=1))
+        db.session.commit()
+        card = Card.query.options(db.selectinload(Card.all_tags)).get(1)
+        self.assertEqual(card.get_tag_names(), ["test", "b", "a"])
+        response = self.client.get("/card/1")
+        self.assertTrue(re.search(">b</a>", response.get_data(as_text=True)))
+
     def test_delete_card(self):
         self.client.post("card/1/delete_card")
         self.assertEqual(Card.query.all(), [])
@@ -250,6 +547,228 @@ class LearnTest(FlaskClientTestCase):
             num_learn = int(num_learn.group(1))
         self.assertEqual(num_learn, 0)
 
+    def test_get_cards_limit_and_priority(self):
+        for num in range(2, 5):
+            quick_create_card(self.client, num=num)
+        response = self.client.get("/get_cards?num_learn=2")
+        self.assertEqual(len(response.get_json()["data"]["cards"]), 2)
+        # Card 1 is due today, the others since 2021-02-14
+        response = self.client.get("/get_cards?num_learn=4&sampling=priority")
+        card_ids = [card["id"] for card in response.get_json()["data"]["cards"]]
+        self.assertEqual(card_ids, [2, 3, 4, 1])
+
+    def test_session_state(self):
+        user = User.query.get(1)
+        lh = LearningHelper(user=user)
+        self.assertEqual(lh.get_last_session_status(), "complete")
+        quick_create_card(self.client, num=2)
+        self.client.post(
+            "/before_learning",
+            data={"mode": "start", "cardsSelected": ",1,2"},
+        )
+        self.assertEqual(lh.get_last_session_status(), "still")
+        self.assertEqual(user.ls_state.num_remaining, 2)
+        self.client.put("/update_lsf_status?is_ok=1&lsf_id=1")
+        # Answering the same card twice must not be counted again
+        self.client.put("/update_lsf_status?is_ok=1&lsf_id=1")
+        db.session.expire_all()
+        self.assertEqual(user.ls_state.num_remaining, 1)
+        self.assertEqual(lh.get_last_session_status(), "still")
+        quick_create_card(self.client, num=3)
+        db.session.expire_all()
+        self.assertEqual(lh.get_last_session_status(), "outdated")
+
+    def test_learning_session_id_allocation(self):
+        for _ in range(2):
+            self.client.post(
+                "/before_learning",
+                data={"mode": "start", "cardsSelected": ",1"},
+            )
+        sessions = LearningSession.query.order_by(LearningSession.id).all()
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(User.query.get(1).current_ls_id, sessions[1].id)
+        self.assertEqual([lsf.id for lsf in sessions[1].ls_facts], [2])
+
+    def test_update_lsf_status_batch(self):
+        quick_create_card(self.client, num=2)
+        self.client.post(
+            "/before_learning",
+            data={"mode": "start", "cardsSelected": ",1,2"},
+        )
+        response = self.client.put(
+            "/update_lsf_status/batch",
+            json={
+                "results": [
+                    {
+                        "lsf_id": 1,
+                        "is_ok": 1,
+                        "start_at": "2021-02-14T10:00:00.000Z",
+                        "complete_at": "2021-02-14T11:00:05+01:00",
+                    },
+                    {"lsf_id": 2, "is_ok": 0},
+                    {"lsf_id": 99, "is_ok": 1},
+                ]
+            },
+        )
+        response = response.get_json()
+        self.assertEqual(response["meta"]["not_found"], [99])
+        self.assertEqual(
+            [(r["card_id"], r["bucket"]) for r in response["data"]["results"]],
+            [(1, 2), (2, 1)],
+        )
+        db.session.expire_all()
+        self.assertEqual(Card.query.get(1).learn_spaced_rep.bucket, 2)
+        self.assertEqual(Card.query.get(2).learn_spaced_rep.bucket, 1)
+        user = User.query.get(1)
+        self.assertEqual(user.ls_state.num_remaining, 0)
+        self.assertEqual(
+            LearningHelper(user=user).get_last_session_status(), "complete"
+        )
+        # Offsets are converted to naive UTC
+        self.assertEqual(
+            LearningSessionFact.query.get(1).complete_at,
+            datetime(2021, 2, 14, 10, 0, 5),
+        )
+        for body in [[{"lsf_id": 1, "is_ok": 1}], {"results": {"lsf_id": 1}}]:
+            response = self.client.put("/update_lsf_status/batch", json=body)
+            self.assertEqual(response.status_code, 400)
+
+    def test_reschedule(self):
+        quick_create_card(self.client, 2)
+        quick_create_card(self.client, 3)
+        mastered, missing = LearnSpacedRepetition.query.filter(
+            LearnSpacedRepetition.id > 1
+        ).all()
+        mastered.bucket = LearnSpacedRepetition.get_max_bucket()
+        missing.next_date = None
+        db.session.commit()
+
+        today = datetime(2021, 2, 10)
+        new_intervals = (0, 3, 1, 1, 2, 2)
+        stats = reschedule(new_intervals=new_intervals, chunk_size=1, today=today)
+        self.assertEqual(stats, {"scanned": 3, "updated": 3})
+        first = LearnSpacedRepetition.query.get(1)
+        self.assertEqual(
+            first.next_date.date(),
+            (datetime.today() + timedelta(days=2)).date(),
+        )
+        self.assertIsNone(LearnSpacedRepetition.query.get(mastered.id).next_date)
+        self.assertEqual(LearnSpacedRepetition.query.get(missing.id).next_date, today)
+        # Rescheduling to the same table only repairs invalid dates
+        stats = reschedule(chunk_size=2, today=today)
+        self.assertEqual(stats, {"scanned": 3, "updated": 0})
+
+    def test_reschedule_drops_cached_forecast(self):
+        self.app.redis = FakeRedis()
+        cache._unavailable_until = 0
+        quick_create_card(self.client, 2)
+        response = self.client.get("/forecast?days=3")
+        self.assertEqual(
+            [day["num_due"] for day in response.get_json()["data"]], [2, 0, 0]
+        )
+        # Two days later, the card of the fixture is now due in two days while
+        # the other one, overdue since 2021, stays due
+        reschedule(new_intervals=(2, 3, 3, 3, 4, 4))
+        response = self.client.get("/forecast?days=3")
+        self.assertEqual(
+            [day["num_due"] for day in response.get_json()["data"]], [1, 0, 1]
+        )
+
+    def test_forecast(self):
+        quick_create_card(self.client, 2)
+        quick_create_card(self.client, 3)
+        later = LearnSpacedRepetition.query.get(3)
+        later.next_date = datetime.utcnow() + timedelta(days=2)
+        db.session.commit()
+        response = self.client.get("/forecast?days=3")
+        self.assertEqual(response.status_code, 200)
+        counts = [day["num_due"] for day in response.get_json()["data"]]
+        self.assertEqual(counts, [2, 0, 1])
+
+        other_tag = Tag(name="other", user_id=1)
+        db.session.add(other_tag)
+        db.session.add(Tagging(tag=other_tag, card_id=3))
+        db.session.commit()
+        response = self.client.get(f"/forecast?days=3&tag_id={other_tag.id}")
+        counts = [day["num_due"] for day in response.get_json()["data"]]
+        self.assertEqual(counts, [0, 0, 1])
+        response = self.client.get("/forecast?days=0")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/stats")
+        self.assertTrue(re.search("Upcoming reviews", response.get_data(as_text=True)))
+
+    def test_learning_prefetch(self):
+        quick_create_card(self.client, 2)
+        quick_create_card(self.client, 3)
+        self.client.post(
+            "/before_learning",
+            data={"mode": "start", "cardsSelected": ",1,2,3"},
+        )
+        self.client.put("/update_lsf_status?is_ok=1&lsf_id=1")
+        response = self.client.get("/learning/prefetch?k=5")
+        ls_facts = response.get_json()["data"]["ls_facts"]
+        self.assertEqual([lsf["lsf_id"] for lsf in ls_facts], [2, 3])
+        self.assertEqual(ls_facts[0]["card"]["front"], "card 2")
+        self.assertEqual(ls_facts[0]["tags"], [{"id": 1, "name": "test"}])
+        self.assertTrue(re.search("card 2", ls_facts[0]["html"]))
+        response = self.client.get("/learning/prefetch?k=1")
+        self.assertEqual(len(response.get_json()["data"]["ls_facts"]), 1)
+        response = self.client.get("/learning/prefetch?k=0")
+        self.assertEqual(response.status_code, 400)
+        # Nothing is prefetched from an outdated or expired session
+        state = User.query.get(1).ls_state
+        state.status = LearningSessionState.STATUS_OUTDATED
+        db.session.commit()
+        response = self.client.get("/learning/prefetch?k=5").get_json()
+        self.assertEqual(response["meta"]["session_status"], "outdated")
+        self.assertEqual(response["data"]["ls_facts"], [])
+        state.status = LearningSessionState.STATUS_STILL
+        state.created_at = state.last_complete_at = datetime(2021, 1, 1)
+        db.session.commit()
+        response = self.client.get("/learning/prefetch?k=5").get_json()
+        self.assertEqual(response["meta"]["session_status"], "expire")
+        self.assertEqual(response["data"]["ls_facts"], [])
+
+    def test_parse_cards_from_selected_str(self):
+        quick_create_card(self.client, 2)
+        other = User(username="other", email="other@example.com")
+        db.session.add(other)
+        db.session.flush()
+        db.session.add(Card(front="other", back="other", user_id=other.id))
+        db.session.commit()
+        cards = LearningHelper.parse_cards_from_selected_str(",2,3,1,2,99", 1)
+        self.assertEqual([card.id for card in cards], [2, 1])
+        self.assertEqual(LearningHelper.parse_cards_from_selected_str("", 1), [])
+
+    def test_simulate(self):
+        quick_create_card(self.client, 2)
+        session = LearningSession(user_id=1)
+        db.session.add(session)
+        answers = {1: [True, True, False, True], 2: [True] * 5}
+        for card_id, is_oks in answers.items():
+            for i, is_ok in enumerate(is_oks):
+                db.session.add(
+                    LearningSessionFact(
+                        learning_session=session,
+                        user_id=1,
+                        card_id=card_id,
+                        number=i + 1,
+                        complete_at=datetime(2021, 2, 1) + timedelta(days=10 * i),
+                        is_ok=is_ok,
+                    )
+                )
+        db.session.commit()
+
+        report = simulate([IntervalScheduler()], chunk_size=3)
+        self.assertEqual(report["num_facts"], 9)
+        result = report["schedulers"][0]
+        self.assertEqual(result["num_mastered"], 1)
+        self.assertEqual(result["mean_reviews_to_mastery"], 5)
+        # Both cards are answered on 2021-02-01, then on the days they are due
+        workload = result["daily_workload"]
+        self.assertEqual(workload["first_day"], "2021-02-01")
+        self.assertEqual(workload["counts"], [2, 2, 3, 0, 1, 0, 1])
+
 
 class SearchTest(FlaskClientTestCase):
     def test_search_title(self):
@@ -260,6 +779,294 @@ class SearchTest(FlaskClientTestCase):
         response = self.client.get("search?q=test")
         self.assertTrue(re.search("test", response.get_data(as_text=True)))
 
+    def test_database_backend(self):
+        backend = self.app.search_backend
+        quick_create_card(self.client, 2)
+        card = Card.query.filter_by(front="card 2").first()
+        self.assertEqual(backend.query_index("card", "2 back!", 1, 10, 1), ([2, 1], 2))
+        self.assertEqual(backend.query_index("card", "back", 2, 1, 1)[0], [2])
+        self.assertEqual(backend.query_index("card", "back", 1, 10, 2), ([], 0))
+        self.assertEqual(backend.query_index("card", '" OR', 1, 10, 1), ([], 0))
+        # Cards match by their tags too, once each
+        self.assertEqual(backend.query_index("card", "test", 1, 10, 1), ([1, 2], 2))
+        self.assertEqual(
+            backend.query_index("card", "front test", 1, 10, 1), ([1, 2], 2)
+        )
+        # The index follows the changes of the table
+        card.back = "edited"
+        db.session.commit()
+        self.assertEqual(backend.query_index("card", "back", 1, 10, 1), ([1], 1))
+        db.session.delete(card)
+        db.session.commit()
+        self.assertEqual(backend.query_index("card", "edited", 1, 10, 1), ([], 0))
+        self.assertEqual(backend.query_index("tag", "TEST", 1, 10, 1), ([1], 1))
+        response = self.client.get("search?q=front")
+        self.assertIn('card_id="1"', response.get_data(as_text=True))
+
+    def test_search_cache(self):
+        self.app.redis = FakeRedis()
+        cache._unavailable_until = 0
+        backend = self.app.search_backend
+        queries = []
+
+        def query_index(index, query, page, per_page, user_id):
+            queries.append((index, query, page, per_page))
+            return backend.query_index(index, query, page, per_page, user_id)
+
+        self.app.search_backend = SimpleNamespace(query_index=query_index)
+        quick_create_card(self.client, 2)
+        limit = self.app.config["SEARCH_CACHE_RESULTS"]
+        # Later pages and the same query in other words come from the cache
+        for url in ["search?q=back", "search?q=back&page=2", "search?q=+BACK"]:
+            self.client.get(url)
+        self.assertIn("card 2", self.client.get("search?q=back").get_data(as_text=True))
+        self.assertEqual(queries, [("card", "back", 1, limit)])
+        # Pages beyond the cached ids are searched directly
+        self.client.get(f"search?q=back&page={limit}")
+        self.assertEqual(queries[-1], ("card", "back", limit, 6))
+        # Learning commits keep the cached searches
+        LearnSpacedRepetition.query.get(2).bucket = 3
+        db.session.commit()
+        self.client.get("search?q=back")
+        self.assertEqual(len(queries), 2)
+        # Commits of indexed fields of the user's cards drop them
+        Card.query.get(2).back = "edited"
+        db.session.commit()
+        self.assertNotIn(
+            "card 2", self.client.get("search?q=back").get_data(as_text=True)
+        )
+        self.assertEqual(len(queries), 3)
+
+    def test_search_outbox(self):
+        es = self.app.elasticsearch = FakeElasticsearch()
+        quick_create_card(self.client, 2)
+        card = Card.query.filter_by(front="card 2").first()
+        card.front = "card 2 edited"
+        db.session.commit()
+        self.assertEqual(
+            SearchIndexOutbox.query.filter_by(index="card", object_id=card.id).count(),
+            3,
+        )
+        # Created, tagged and edited, one action with its latest state
+        self.assertEqual(SearchIndexOutbox.drain(), (1, 0))
+        self.assertEqual(
+            es.requests[0],
+            [
+                {"index": {"_index": "card", "_id": card.id}},
+                {
+                    "front": "card 2 edited",
+                    "back": "card 2 back",
+                    "user_id": 1,
+                    "tags": ["test"],
+                },
+            ],
+        )
+        self.assertEqual(SearchIndexOutbox.query.count(), 0)
+        # Renaming a tag reindexes its cards
+        Tag.query.get(1).name = "renamed"
+        db.session.commit()
+        SearchIndexOutbox.drain()
+        self.assertEqual(
+            [
+                (action["index"]["_index"], action["index"]["_id"])
+                for action in es.requests[-1][0::2]
+            ],
+            [("card", 1), ("card", 2), ("tag", 1)],
+        )
+        self.assertEqual(es.requests[-1][3]["tags"], ["renamed"])
+        # Fields out of the documents are not indexed
+        skipped = Card.index_writes["skipped"]
+        card.timestamp = datetime(2021, 1, 1)
+        db.session.commit()
+        self.assertEqual(SearchIndexOutbox.query.count(), 0)
+        self.assertEqual(Card.index_writes["skipped"], skipped + 1)
+        # Failed actions stay queued
+        es.failing = {card.id}
+        card.back = "edited"
+        db.session.commit()
+        self.assertEqual(SearchIndexOutbox.drain(), (0, 1))
+        self.assertEqual(SearchIndexOutbox.query.one().attempts, 1)
+        es.failing = set()
+        db.session.delete(card)
+        db.session.commit()
+        self.assertEqual(SearchIndexOutbox.drain(), (1, 0))
+        self.assertEqual(es.requests[-1], [{"delete": {"_index": "card", "_id": 2}}])
+        self.assertEqual(SearchIndexOutbox.query.count(), 0)
+
+    def test_search_outbox_give_up(self):
+        es = self.app.elasticsearch = FakeElasticsearch()
+        quick_create_card(self.client, 2)
+        es.failing = {2}
+        for _ in range(SearchIndexOutbox.MAX_ATTEMPTS - 1):
+            self.assertEqual(SearchIndexOutbox.drain(), (0, 2))
+        with self.assertLogs(self.app.logger, "ERROR") as logs:
+            SearchIndexOutbox.drain()
+        self.assertIn("gave up on card 2", logs.output[-1])
+        # Later drains skip the rows given up on, until they are requeued
+        self.assertEqual(SearchIndexOutbox.drain(), (0, 0))
+        es.failing = set()
+        self.assertEqual(SearchIndexOutbox.drain(), (0, 0))
+        self.assertEqual(SearchIndexOutbox.requeue(index="tag"), 0)
+        self.assertEqual(SearchIndexOutbox.requeue(), 2)
+        self.assertEqual(SearchIndexOutbox.drain(), (1, 0))
+        self.assertEqual(SearchIndexOutbox.query.count(), 0)
+
+    def test_reindex(self):
+        es = self.app.elasticsearch = FakeElasticsearch()
+        for num in range(2, 6):
+            quick_create_card(self.client, num)
+        self.assertEqual(get_id_ranges(Card, 2), [(0, 3), (3, None)])
+        checkpoint_dir = tempfile.mkdtemp()
+        counts = reindex(["card"], chunk_size=2, checkpoint_dir=checkpoint_dir)
+        self.assertEqual(counts, {"card": 5})
+        self.assertEqual([len(body) // 2 for body in es.requests], [2, 2, 1])
+        # An interrupted run resumes after the last chunk indexed
+        es.requests = []
+        ReindexCheckpoint(checkpoint_dir).set_last_id("card", 0, 3)
+        counts = reindex(["card"], chunk_size=2, checkpoint_dir=checkpoint_dir)
+        self.assertEqual(counts, {"card": 2})
+        self.assertEqual(
+            es.requests[0][0::2],
+            [
+                {"index": {"_index": "card", "_id": 4}},
+                {"index": {"_index": "card", "_id": 5}},
+            ],
+        )
+        es.failing = {3}
+        with self.assertRaises(BulkIndexError):
+            Card.reindex()
+        # Parallel ranges, in worker processes with their own application
+        counts = reindex(["card", "tag"], workers=2, config_name="testing")
+        self.assertEqual(counts, {"card": 5, "tag": 1})
+
+    def test_rebuild(self):
+        es = self.app.elasticsearch = FakeElasticsearch()
+        # An index created before the aliases
+        es.indices.indexes["card"] = {}
+        target = create_index_version("card", Card.get_mapping())
+        self.assertEqual(target, "card_v1")
+        self.assertEqual(es.indices.indexes[target]["number_of_replicas"], 0)
+        self.assertEqual(get_write_indexes("card"), ["card", "card_v1"])
+        # Changes made during the load go to both versions
+        card = Card.query.get(1)
+        card.front = "edited"
+        db.session.commit()
+        SearchIndexOutbox.drain()
+        self.assertEqual(
+            [action["index"]["_index"] for action in es.requests[-1][0::2]],
+            ["card", "card_v1"],
+        )
+        self.assertEqual(swap_index_version("card", target, 1), [])
+        self.assertEqual(
+            es.indices.get_aliases(), {"card": {"card_v1"}, "card_write": {"card_v1"}}
+        )
+        self.assertNotIn("card", es.indices.indexes)
+        self.assertEqual(es.indices.indexes[target]["number_of_replicas"], 1)
+        # Next versions are loaded aside, then swapped
+        es.requests = []
+        self.assertEqual(rebuild(["card"]), {"card": 1})
+        self.assertEqual(es.requests[0][0], {"create": {"_index": "card_v2", "_id": 1}})
+        self.assertEqual(
+            es.indices.get_aliases(), {"card": {"card_v2"}, "card_write": {"card_v2"}}
+        )
+        self.assertEqual(list(es.indices.indexes), ["card_v2"])
+
+
+class FakeIndices(object):
+    """Indexes and aliases, as far as the index versions use them"""
+
+    def __init__(self):
+        self.indexes = {}
+        self.aliases = defaultdict(set)
+
+    def get_aliases(self):
+        return {alias: names for alias, names in self.aliases.items() if names}
+
+    def get(self, index):
+        return {name: {} for name in self.indexes if name.startswith(index[:-1])}
+
+    def create(self, index, body):
+        self.indexes[index] = dict(body["settings"])
+
+    def exists(self, index):
+        return index in self.indexes or bool(self.aliases.get(index))
+
+    def exists_alias(self, name):
+        return bool(self.aliases.get(name))
+
+    def get_alias(self, name):
+        if not self.aliases.get(name):
+            raise NotFoundError(404, "aliases_not_found_exception")
+        return {index: {} for index in self.aliases[name]}
+
+    def put_alias(self, index, name):
+        self.aliases[name].add(index)
+
+    def put_settings(self, index, body):
+        self.indexes[index].update(body["index"])
+
+    def refresh(self, index):
+        pass
+
+    def update_aliases(self, body):
+        for action in body["actions"]:
+            ((kind, args),) = action.items()
+            if kind == "add":
+                self.aliases[args["alias"]].add(args["index"])
+            elif kind == "remove":
+                self.aliases[args["alias"]].remove(args["index"])
+            else:
+                self.delete(args["index"])
+
+    def delete(self, index):
+        for name in index.split(","):
+            del self.indexes[name]
+            for names in self.aliases.values():
+                names.discard(name)
+
+
+class FakeElasticsearch(object):
+    """Records the bulk requests, the actions on `failing` ids fail"""
+
+    def __init__(self):
+        self.requests = []
+        self.failing = set()
+        self.indices = FakeIndices()
+
+    def bulk(self, body):
+        self.requests.append(body)
+        items = []
+        i = 0
+        while i < len(body):
+            ((action, meta),) = body[i].items()
+            i += 1 if action == "delete" else 2
+            status = 500 if meta["_id"] in self.failing else 200
+            items.append({action: dict(meta, _id=str(meta["_id"]), status=status)})
+        return {"errors": bool(self.failing), "items": items}
+
+
+class FakeRedis(object):
+    """Keys and values of the cache, without expiry"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key) or 0) + 1
+
+    def pipeline(self):
+        calls = []
+        return SimpleNamespace(
+            incr=lambda key: calls.append(key),
+            execute=lambda: [self.incr(key) for key in calls],
+        )
+
 
 def quick_create_card(client, num: int):
     client.post(
@@ -276,6 +1083,60 @@ def quick_create_card(client, num: int):
     )
 
 
+class ApiTest(FlaskClientTestCase):
+    def test_collections(self):
+        user = User.query.filter_by(username="admin").first()
+        for i in range(3):
+            lsr = LearnSpacedRepetition(next_date=datetime(2021, 1, 1), bucket=2)
+            db.session.add(lsr)
+            db.session.flush()
+            db.session.add(
+                Card(
+                    front=f"f{i}",
+                    back=f"b{i}",
+                    learn_spaced_rep_id=lsr.id,
+                    user_id=user.id,
+                )
+            )
+        token = user.get_token()
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get(
+            f"/api/cards/user/{user.id}?page=2&per_page=3", headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["_meta"]["total_items"], 4)
+        self.assertEqual(data["_meta"]["total_pages"], 2)
+        self.assertIsNone(data["_links"]["next"])
+        self.assertIsNotNone(data["_links"]["prev"])
+        card = Card.query.filter_by(front="f2").first()
+        # Same links as inside a request
+        with self.app.test_request_context():
+            self.assertEqual(data["item"], [card.to_dict()])
+
+        response = self.client.get(f"/api/tags/user/{user.id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        tag = Tag.query.filter_by(user_id=user.id).first()
+        self.assertEqual(data["item"][0]["card_ids"], [1])
+        response = self.client.get(f"/api/tags/{tag.id}", headers=headers)
+        with self.app.test_request_context():
+            self.assertEqual(data["item"], [tag.to_dict()])
+            self.assertEqual(response.get_json(), tag.to_dict())
+        # Out of range pages are clamped, as paginate does
+        for url, num_items in [
+            (f"/api/cards/user/{user.id}?page=0&per_page=-3", 1),
+            (f"/api/users/{user.id}/cards?page=-1", 4),
+            (f"/api/tags/user/{user.id}?page=0&per_page=0", 1),
+        ]:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            self.assertEqual(data["_meta"]["page"], 1)
+            self.assertEqual(len(data["item"]), num_items)
+
+
 class SeleniumTestCase(FlaskClientTestCase):
     client = None
 
@@ -29,6 +29,14 @@ config.set_main_option(
 )
 target_metadata = current_app.extensions["migrate"].db.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    # The SQLite full-text tables are created with the searchable tables
+    if type_ == "table" and reflected and "_fts" in name:
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -83,6 +91,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions["migrate"].configure_args,
         )
 
@@ -0,0 +1,65 @@
+"""add LearningSessionState
+
+Revision ID: 3f1c2b9a7d64
+Revises: f2efdd407976
+Create Date: 2026-10-18 09:12:41.203117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f1c2b9a7d64"
+down_revision = "f2efdd407976"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "learning_session_state",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("ls_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(length=16), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("last_complete_at", sa.DateTime(), nullable=True),
+        sa.Column("num_remaining", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["user.id"], name=op.f("fk_learning_session_state_user_id_user")
+        ),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_learning_session_state")),
+    )
+    # Backfill the state of the sessions which are in progress
+    op.execute(
+        """
+        INSERT INTO learning_session_state
+            (user_id, ls_id, status, created_at, last_complete_at, num_remaining)
+        SELECT
+            s.user_id,
+            s.ls_id,
+            CASE WHEN EXISTS (
+                SELECT 1 FROM card c
+                WHERE c.user_id = s.user_id AND c.timestamp > s.created_at
+            ) THEN 'outdated' ELSE 'still' END,
+            s.created_at,
+            s.last_complete_at,
+            s.num_remaining
+        FROM (
+            SELECT
+                u.id AS user_id,
+                u.current_ls_id AS ls_id,
+                MIN(lsf.created_at) AS created_at,
+                MAX(lsf.complete_at) AS last_complete_at,
+                SUM(CASE WHEN lsf.complete_at IS NULL THEN 1 ELSE 0 END)
+                    AS num_remaining
+            FROM "user" u
+            JOIN learning_session_fact lsf ON lsf.ls_id = u.current_ls_id
+            GROUP BY u.id, u.current_ls_id
+        ) s
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("learning_session_state")
@@ -0,0 +1,75 @@
+"""add LearningSession
+
+Revision ID: 8d4e6a1f0c35
+Revises: 3f1c2b9a7d64
+Create Date: 2026-10-18 10:03:17.514902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d4e6a1f0c35"
+down_revision = "3f1c2b9a7d64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "learning_session",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["user.id"], name=op.f("fk_learning_session_user_id_user")
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_learning_session")),
+    )
+    with op.batch_alter_table("learning_session", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_learning_session_user_id"), ["user_id"], unique=False
+        )
+
+    # Every existing ls_id becomes a LearningSession with the same id
+    op.execute(
+        """
+        INSERT INTO learning_session (id, user_id, created_at)
+        SELECT ls_id, MIN(user_id), MIN(created_at)
+        FROM learning_session_fact
+        GROUP BY ls_id
+        """
+    )
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(
+            """
+            SELECT setval(
+                pg_get_serial_sequence('learning_session', 'id'),
+                COALESCE(MAX(id), 0) + 1,
+                false
+            )
+            FROM learning_session
+            """
+        )
+
+    with op.batch_alter_table("learning_session_fact", schema=None) as batch_op:
+        batch_op.create_foreign_key(
+            batch_op.f("fk_learning_session_fact_ls_id_learning_session"),
+            "learning_session",
+            ["ls_id"],
+            ["id"],
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("learning_session_fact", schema=None) as batch_op:
+        batch_op.drop_constraint(
+            batch_op.f("fk_learning_session_fact_ls_id_learning_session"),
+            type_="foreignkey",
+        )
+
+    with op.batch_alter_table("learning_session", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_learning_session_user_id"))
+
+    op.drop_table("learning_session")
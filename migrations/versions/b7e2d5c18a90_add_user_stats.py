@@ -0,0 +1,43 @@
+"""add UserStats
+
+Revision ID: b7e2d5c18a90
+Revises: 8d4e6a1f0c35
+Create Date: 2026-10-18 19:31:05.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b7e2d5c18a90"
+down_revision = "8d4e6a1f0c35"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_stats",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("card_count", sa.Integer(), nullable=False),
+        sa.Column("tag_count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["user.id"], name=op.f("fk_user_stats_user_id_user")
+        ),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_user_stats")),
+    )
+    op.execute(
+        """
+        INSERT INTO user_stats (user_id, card_count, tag_count)
+        SELECT
+            u.id,
+            (SELECT COUNT(*) FROM card c WHERE c.user_id = u.id),
+            (SELECT COUNT(*) FROM tag t WHERE t.user_id = u.id)
+        FROM "user" u
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("user_stats")
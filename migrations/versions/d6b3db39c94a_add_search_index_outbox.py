@@ -0,0 +1,32 @@
+"""add SearchIndexOutbox
+
+Revision ID: d6b3db39c94a
+Revises: b7e2d5c18a90
+Create Date: 2026-10-18 19:26:03.418903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d6b3db39c94a"
+down_revision = "b7e2d5c18a90"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "search_index_outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("index", sa.String(length=64), nullable=False),
+        sa.Column("object_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_search_index_outbox")),
+    )
+
+
+def downgrade():
+    op.drop_table("search_index_outbox")
@@ -0,0 +1,71 @@
+"""add full-text search indexes
+
+Revision ID: e1f4c7a9b2d6
+Revises: d6b3db39c94a
+Create Date: 2026-10-18 21:04:12.530118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e1f4c7a9b2d6"
+down_revision = "d6b3db39c94a"
+branch_labels = None
+depends_on = None
+
+SEARCHABLE = {"card": ["front", "back"], "tag": ["name"]}
+
+
+def sqlite_statements(table, fields):
+    columns = ", ".join(fields)
+    new_values = ", ".join(f"new.{field}" for field in fields)
+    old_values = ", ".join(f"old.{field}" for field in fields)
+    insert = f"INSERT INTO {table}_fts(rowid, {columns}) VALUES (new.id, {new_values});"
+    delete = (
+        f"INSERT INTO {table}_fts({table}_fts, rowid, {columns}) "
+        f"VALUES ('delete', old.id, {old_values});"
+    )
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+        f"{columns}, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update "
+        f"AFTER UPDATE OF {columns} ON {table} BEGIN {delete} {insert} END",
+        f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+    ]
+
+
+def postgres_statements(table, fields):
+    document = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+    return [
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+        f"USING GIN (to_tsvector('simple', {document}))"
+    ]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, fields in SEARCHABLE.items():
+        if dialect == "sqlite":
+            statements = sqlite_statements(table, fields)
+        elif dialect == "postgresql":
+            statements = postgres_statements(table, fields)
+        else:
+            statements = []
+        for statement in statements:
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in SEARCHABLE:
+        if dialect == "sqlite":
+            for trigger in ("insert", "delete", "update"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{trigger}")
+            op.execute(f"DROP TABLE IF EXISTS {table}_fts")
+        elif dialect == "postgresql":
+            op.execute(f"DROP INDEX IF EXISTS ix_{table}_search")
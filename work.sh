@@ -1,4 +1,4 @@
 #!/bin/sh
 source alpine/bin/activate
 
-rq worker alpine-tasks -u $REDIS_URL
\ No newline at end of file
+rq worker alpine-tasks -u $REDIS_URL --with-scheduler
\ No newline at end of file